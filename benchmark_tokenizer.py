@@ -0,0 +1,140 @@
+import glob
+import time
+import random
+import string
+import argparse
+
+from src import encoder
+
+parser = argparse.ArgumentParser(description='Input argument parser.')
+
+parser.add_argument('--model_dir', type=str, help='path of model folder, only encoder.json and vocab.bpe are read')
+
+parser.add_argument('--files', type=str, nargs='*', help='text files encoded by both encoders',
+                    default=sorted(glob.glob('dataset/*.txt')))
+
+parser.add_argument('--cache_size', type=int, help='number of words kept in the cache of the encoder',
+                    default=2 ** 16)
+
+parser.add_argument('--long_length', type=int, help='number of characters of the generated long words, 0 skips them',
+                    default=4096)
+
+args = parser.parse_args()
+
+#python benchmark_tokenizer.py --model_dir=models/124M/
+
+
+class ReferenceEncoder(encoder.Encoder):
+    """Encoder with the merge loop it had before the heap and an unbounded cache, to check against and compare with."""
+
+    def __init__(self, *args, **kwargs):
+        super(ReferenceEncoder, self).__init__(*args, **kwargs)
+        self.cache = {}
+
+    def bpe(self, token):
+        if token in self.cache:
+            return self.cache[token]
+        word = tuple(token)
+        pairs = encoder.get_pairs(word)
+
+        if not pairs:
+            return token
+
+        while True:
+            bigram = min(pairs, key = lambda pair: self.bpe_ranks.get(pair, float('inf')))
+            if bigram not in self.bpe_ranks:
+                break
+            first, second = bigram
+            new_word = []
+            i = 0
+            while i < len(word):
+                try:
+                    j = word.index(first, i)
+                    new_word.extend(word[i:j])
+                    i = j
+                except:
+                    new_word.extend(word[i:])
+                    break
+
+                if word[i] == first and i < len(word)-1 and word[i+1] == second:
+                    new_word.append(first+second)
+                    i += 2
+                else:
+                    new_word.append(word[i])
+                    i += 1
+            new_word = tuple(new_word)
+            word = new_word
+            if len(word) == 1:
+                break
+            else:
+                pairs = encoder.get_pairs(word)
+        word = ' '.join(word)
+        self.cache[token] = word
+        return word
+
+
+def timed(function, *inputs):
+    start = time.time()
+    result = function(*inputs)
+    return result, time.time() - start
+
+
+def words(enc, text):
+    # The pre-tokenized words of a text, as bpe() receives them
+    return [''.join(enc.byte_encoder[b] for b in token.encode('utf-8')) for token in enc.pat.findall(text)]
+
+
+def main():
+    if not args.model_dir:
+        print('model_dir must be provided.')
+        print('quit program.')
+        exit()
+
+    enc = encoder.get_encoder(args.model_dir + 'encoder.json', args.model_dir + 'vocab.bpe')
+    merges = sorted(enc.bpe_ranks, key=enc.bpe_ranks.get)
+    mismatches = 0
+
+    for path in args.files:
+        # Read like the dataset loader does
+        with open(path, 'r', encoding='utf8', errors='ignore') as f:
+            text = f.read()
+        # Fresh encoders, so both start with an empty cache
+        reference = ReferenceEncoder(enc.encoder, merges)
+        current = encoder.Encoder(enc.encoder, merges, cache_size=args.cache_size)
+        reference_tokens, reference_time = timed(reference.encode, text)
+        tokens, current_time = timed(current.encode, text)
+        mismatches += tokens != reference_tokens
+        stats = current.cache_stats()
+        print('%s: %.1f MB, %d tokens, %s' % (
+            path, len(text.encode('utf-8')) / 2 ** 20, len(tokens), 'identical' if tokens == reference_tokens else 'DIFFERENT'))
+        print('  encode: %.0f tokens/s before, %.0f tokens/s now, cache hit rate %.1f%% with %d words kept' % (
+            len(tokens) / reference_time, len(tokens) / current_time, 100.0 * stats['hit_rate'], stats['entries']))
+
+        # The merges alone, once per distinct word, without any cache
+        distinct = list(set(words(enc, text)))
+        reference.cache, current.cache_size = {}, 0
+        current.cache.clear()
+        reference_words, reference_time = timed(lambda: [reference.bpe(word) for word in distinct])
+        current_words, current_time = timed(lambda: [current.bpe(word) for word in distinct])
+        mismatches += current_words != reference_words
+        print('  merge %d distinct words: %.2fs before, %.2fs now' % (len(distinct), reference_time, current_time))
+
+    if args.long_length > 0:
+        # Words the pattern does not split, like runs of letters or punctuation pasted in the chat
+        rng = random.Random(0)
+        letters = ''.join(rng.choice(string.ascii_letters) for _ in range(args.long_length))
+        punctuation = ''.join(rng.choice('!?.,;:-_=+*/#@&%$') for _ in range(args.long_length))
+        for name, text in [('letters', letters), ('punctuation', punctuation), ('repeated', '!' * args.long_length)]:
+            reference = ReferenceEncoder(enc.encoder, merges)
+            current = encoder.Encoder(enc.encoder, merges, cache_size=args.cache_size)
+            reference_tokens, reference_time = timed(reference.encode, text)
+            tokens, current_time = timed(current.encode, text)
+            mismatches += tokens != reference_tokens
+            print('%s of %d characters: %s, %.3fs before, %.3fs now' % (
+                name, len(text), 'identical' if tokens == reference_tokens else 'DIFFERENT', reference_time, current_time))
+
+    print('all outputs identical' if mismatches == 0 else '%d outputs differ' % mismatches)
+
+
+if __name__ == '__main__':
+    main()
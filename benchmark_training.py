@@ -0,0 +1,99 @@
+import time
+import resource
+import argparse
+import multiprocessing
+
+import numpy as np
+import tensorflow as tf
+
+from src import net
+
+parser = argparse.ArgumentParser(description='Input argument parser.')
+
+parser.add_argument('--model_dir', type=str, help='path of model folder, only hparams.json is read')
+
+parser.add_argument('--length', type=int, help='length of input sequence (number of tokens)',
+                    default=1024)
+
+parser.add_argument('--batch_size', type=int, help='batch size',
+                    default=1)
+
+parser.add_argument('--block_size', type=int, help='keys per tile of the blockwise attention, 0 skips it',
+                    default=128)
+
+parser.add_argument('--recompute', type=str, help='comma separated numbers of encoder blocks per checkpoint segment to compare, empty skips them',
+                    default='1,2,4')
+
+parser.add_argument('--steps', type=int, help='number of timed training steps for every attention',
+                    default=5)
+
+parser.add_argument('--mixed_precision', type=str, help='also compare mixed precision training in this dtype',
+                    choices=['float16', 'bfloat16'])
+
+args = parser.parse_args()
+
+#python benchmark_training.py --model_dir=models/124M/ --length=1024 --block_size=128 --recompute=1,2,4
+
+
+def measure(args, block_size, recompute, precision, results):
+    # One training setup per process, so the peak memory of one setting does not hide the others
+    tf.keras.utils.set_random_seed(0)
+    model = net.create_model(args, precision=precision, block_size=block_size)
+    n_vocab = model.get_layer(name='Embed-Token').input_dim
+    if recompute:
+        model = net.recompute_model(model, recompute)
+    optimizer = tf.keras.optimizers.Adam()
+    if precision == 'mixed_float16':
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    model.compile(optimizer=optimizer, loss=net.loss)
+    x = np.random.RandomState(0).randint(0, n_vocab, (args.batch_size, args.length))
+    y = x[:, 1:]
+
+    # The first step builds the graph and is not timed
+    loss = float(model.train_on_batch(x, y))
+    start = time.time()
+    for _ in range(args.steps):
+        model.train_on_batch(x, y)
+    step_time = (time.time() - start) / args.steps
+
+    if tf.config.list_physical_devices('GPU'):
+        peak = tf.config.experimental.get_memory_info('GPU:0')['peak']
+        device = 'GPU'
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        device = 'process'
+    results.put((loss, step_time, peak, device))
+
+
+def main():
+    if not args.model_dir:
+        print('model_dir must be provided.')
+        print('quit program.')
+        exit()
+
+    args.json_hparams = args.model_dir + "hparams.json"
+
+    context = multiprocessing.get_context('spawn')
+    print('length %d, batch size %d, %d steps' % (args.length, args.batch_size, args.steps))
+    settings = [('full', None, 0, 'float32')]
+    if args.block_size:
+        settings.append(('blockwise %d' % args.block_size, args.block_size, 0, 'float32'))
+    for every in [int(x) for x in args.recompute.split(',') if x]:
+        settings.append(('recompute %d' % every, None, every, 'float32'))
+    if args.mixed_precision:
+        settings.append(('mixed %s' % args.mixed_precision, None, 0, 'mixed_' + args.mixed_precision))
+    for name, block_size, recompute, precision in settings:
+        results = context.Queue()
+        process = context.Process(target=measure, args=(args, block_size, recompute, precision, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print('%-16s failed' % name)
+            continue
+        loss, step_time, peak, device = results.get()
+        print('%-16s first loss %.5f, %.1f ms per step, %.0f tokens/s, peak %s memory %.0f MB' % (
+            name, loss, 1000 * step_time, args.batch_size * args.length / step_time, device, peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import time
+import argparse
+
+import numpy as np
+
+from src import net
+
+parser = argparse.ArgumentParser(description='Input argument parser.')
+
+parser.add_argument('--model_dir', type=str, help='path of model folder')
+
+parser.add_argument('--custom_model', type=str, help='path to custom model')
+
+parser.add_argument('--output_name', type=str, help='path of the flat .gptw weight file')
+
+parser.add_argument('--float16', help='store the floating point weights in float16, half the size of the file',
+                    action='store_true')
+
+parser.add_argument('--quantized', help='the custom .h5 model holds int8 weights written by quantize.py',
+                    action='store_true')
+
+args = parser.parse_args()
+
+#python convert.py --model_dir=models/355M/ --output_name=models/355M/model.gptw --float16
+
+
+def main():
+    if not args.model_dir or not args.output_name:
+        print('model_dir and output_name must be provided.')
+        print('quit program.')
+        exit()
+
+    if args.custom_model:
+        args.model_path = args.custom_model
+    else:
+        args.model_path = args.model_dir + "model.ckpt"
+
+    args.json_hparams = args.model_dir + "hparams.json"
+
+    # Checkpoints only hold float32 weights
+    quantized = args.quantized and args.model_path.split('.')[-1] == 'h5'
+
+    start = time.time()
+    if args.model_path.split('.')[-1] == 'h5':
+        model = net.create_model(args, past=True, quantized=quantized)
+        model = net.load_h5_weights(model, args.model_path)
+    elif args.model_path.split('.')[-1] == 'ckpt':
+        args.model_ckpt = args.model_path
+        model = net.create_model(args, past=True)
+        model = net.load_weights(model, args)
+    else:
+        print('Unrecognized model format: ' + args.model_path.split('.')[-1])
+        exit()
+    load_time = time.time() - start
+
+    net.save_flat_weights(model, args.output_name, dtype='float16' if args.float16 else None)
+    print('saved ' + args.output_name)
+
+    # Load it back into a fresh model to check it and compare the startup time
+    start = time.time()
+    flat_model = net.create_model(args, past=True, quantized=quantized)
+    flat_model = net.load_flat_weights(flat_model, args.output_name)
+    flat_time = time.time() - start
+    difference = max(float(np.max(np.abs(weight.astype(np.float32) - flat_weight.astype(np.float32))))
+                     for weight, flat_weight in zip(model.get_weights(), flat_model.get_weights()))
+    print('largest difference of the weights read back: %g' % difference)
+    print('loading: %.2fs from %s, %.2fs from %s' % (load_time, args.model_path, flat_time, args.output_name))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,10 +7,8 @@ import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras.callbacks import LearningRateScheduler
 
-from src.layers import EmbeddingSim, EmbeddingRet, PositionEmbedding, LayerNormalization, _get_encoder_component, gelu, ScaledDotProductAttention, MultiHeadAttention, FeedForward
 from src import encoder
 from src import net
-from src import utils
 
 parser = argparse.ArgumentParser(description='Input argument parser.')
 
@@ -48,6 +46,18 @@ parser.add_argument('--data_loader', type=str, help='type of dataset',
 
 parser.add_argument('--output_name', type=str, help='name of output model')
 
+parser.add_argument('--attention_block', type=int, help='keys per tile of the memory-efficient blockwise attention, 0 computes the full attention matrix',
+                    default=0)
+
+parser.add_argument('--recompute', type=int, help='keep the activations only at the input of every k-th encoder block and recompute the rest in the backward pass, 0 keeps all of them',
+                    default=0)
+
+parser.add_argument('--accum_steps', type=int, help='number of batches of --batch_size whose gradients are accumulated into every optimizer update',
+                    default=1)
+
+parser.add_argument('--mixed_precision', type=str, help='train the attention and feed-forward layers in half precision, with float32 weights',
+                    choices=['float16', 'bfloat16'])
+
 args = parser.parse_args()
 
 #python finetune.py --model_dir=models/124M/ --output_name=touhou_124_5x10.h5 --dataset_path=dataset/touhou-nsfw.txt --data_loader=text --num_epoch=5 --decay_epochs="4,5" --steps_per_epoch=10
@@ -74,45 +84,51 @@ def main():
 
     ds = importlib.import_module(
         "src.load_" + args.data_loader).create_dataset(
-        enc, args.length, args.dataset_path, args.batch_size, args.steps_per_epoch, args.num_epoch)
+        enc, args.length, args.dataset_path, args.batch_size * args.accum_steps, args.steps_per_epoch, args.num_epoch)
         
     # Setup TensorFlow to use a distribution strategy to perform compute across multiple devices.
     strategy = tf.distribute.experimental.CentralStorageStrategy()
+    if args.mixed_precision:
+        # Keras refuses mixed precision layers under CentralStorageStrategy
+        strategy = tf.distribute.MirroredStrategy()
     with strategy.scope():
+        precision = 'mixed_' + args.mixed_precision if args.mixed_precision else 'float32'
         if args.model.split('.')[-1] == 'h5':
-            model = keras.models.load_model(
-            args.model,
-            custom_objects={'EmbeddingSim': EmbeddingSim,
-                            'EmbeddingRet': EmbeddingRet,
-                            'PositionEmbedding': PositionEmbedding,
-                            'LayerNormalization': LayerNormalization,
-                            'ScaledDotProductAttention': ScaledDotProductAttention,
-                            'MultiHeadAttention': MultiHeadAttention,
-                            'FeedForward': FeedForward,
-                            'gelu': gelu,
-                            'loss': net.loss})
+            # Rebuilt from hparams.json, so models saved before the attention projections were fused load too
+            model = net.create_model(args, precision=precision, block_size=args.attention_block or None)
+            model = net.load_h5_weights(model, args.model)
         elif args.model.split('.')[-1] == 'ckpt':
             args.model_ckpt = args.model
-            model = net.create_model(args)
+            model = net.create_model(args, precision=precision, block_size=args.attention_block or None)
             model = net.load_weights(model, args)
         else:
             print('Unrecognized model format')
             exit()
 
-        model.compile(
-            optimizer=keras.optimizers.Adam(),
+        # Trained through the checkpointed copy, which shares the weights of the model that is saved
+        train_model = net.recompute_model(model, args.recompute) if args.recompute > 0 else model
+        if args.accum_steps > 1:
+            train_model = net.GradientAccumulation(train_model, args.accum_steps)
+
+        optimizer = keras.optimizers.Adam()
+        if args.mixed_precision == 'float16':
+            # Small float16 gradients underflow to zero, bfloat16 has the range of float32 and does not need it
+            optimizer = keras.mixed_precision.LossScaleOptimizer(optimizer)
+
+        train_model.compile(
+            optimizer=optimizer,
             loss=net.loss
         )
 
     # fine tune
-    model.fit(ds,
-              epochs=args.num_epoch,
-              steps_per_epoch=args.steps_per_epoch,
-              callbacks=[LearningRateScheduler(net.create_schedule(args))])
+    train_model.fit(ds,
+                    epochs=args.num_epoch,
+                    steps_per_epoch=args.steps_per_epoch,
+                    callbacks=[LearningRateScheduler(net.create_schedule(args))])
 
     model.save(os.path.join('output', args.output_name), include_optimizer=False)
 
-    model.evaluate(ds)
+    train_model.evaluate(ds)
 
 if __name__ == '__main__':
     main()
@@ -2,14 +2,9 @@ import numpy as np
 import argparse
 
 
-import tensorflow as tf
-from tensorflow import keras
-
-
-from src.layers import EmbeddingSim, EmbeddingRet, PositionEmbedding, LayerNormalization, _get_encoder_component, gelu, ScaledDotProductAttention, MultiHeadAttention, FeedForward
 from src import encoder
-from src import net
-from src import utils
+from src import stopping
+from src import client
 
 
 parser = argparse.ArgumentParser(description='Input argument parser.')
@@ -37,10 +32,69 @@ parser.add_argument('--output_length', type=int, help='length of output sequence
 
 parser.add_argument('--starter', type=str, help='starter sentence')
 
+parser.add_argument('--seed', type=int, help='random seed for sampling, leave unset for a different result every run',
+					default=None)
+
+parser.add_argument('--graph_loop', help='run the whole generation loop in one TensorFlow graph', action='store_true')
+
+parser.add_argument('--draft_model_dir', type=str, help='path of a smaller model folder with the same vocabulary, turns on speculative decoding')
+
+parser.add_argument('--draft_length', type=int, help='number of tokens proposed by the draft model at a time',
+					default=4)
+
+parser.add_argument('--beams', type=int, help='number of beams, turns on beam search instead of sampling when above 0',
+					default=0)
+
+parser.add_argument('--length_penalty', type=float, help='length normalization exponent of beam search, higher values favour longer outputs',
+					default=1.0)
+
+parser.add_argument('--n_best', type=int, help='number of beam search results printed',
+					default=1)
+
+parser.add_argument('--stop', type=str, action='append', help='stop string, can be given several times. The first line break always stops the generation',
+					default=[])
+
+parser.add_argument('--precision', type=str, help='dtype of the weights and matrix products, the normalization, softmax and logits stay in float32',
+					default='float32', choices=['float32', 'float16', 'bfloat16'])
+
+parser.add_argument('--quantized', help='the custom .h5 or .gptw model holds int8 weights written by quantize.py', action='store_true')
+
+parser.add_argument('--server', type=str, help='address of a running server.py, e.g. http://127.0.0.1:8000. The text is generated there instead of loading the model here')
+
 args = parser.parse_args()
 
 
+def run_client(args):
+	# the model stays loaded in the server, batch_size, beams, graph_loop and the draft model do not apply
+	settings = dict(max_tokens=args.output_length, temperature=args.temperature, seed=args.seed, stop=args.stop, newline=True)
+	if args.nucleus:
+		settings['top_p'] = args.top_p
+	else:
+		settings['top_k'] = args.top_k
+
+	print(args.starter, end='', flush=True)
+	for event in client.stream(args.server, args.starter, **settings):
+		if 'error' in event:
+			print()
+			print('server error: ' + event['error'])
+			return
+		print(event.get('text', ''), end='', flush=True)
+	print()
+
+
 def main():
+	args.starter = args.starter.replace("\\n", "\n")
+	args.starter = args.starter.replace("\\'", "'")
+
+	if args.server:
+		run_client(args)
+		return
+
+	# TensorFlow is only imported to run the model here, the client mode does without it
+	from src import net
+	from src import generate
+	from src import speculative
+
 	if not args.model_dir:
 		print('model path must be provided.')
 		print('quit program.')
@@ -55,71 +109,94 @@ def main():
 	args.json_encoder = args.model_dir + "encoder.json"
 	args.vocab_bpe = args.model_dir + "vocab.bpe"
 
-	args.starter = args.starter.replace("\\n", "\n")
-	args.starter = args.starter.replace("\\'", "'")
-
 	print()
 	
 	enc = encoder.get_encoder(args.json_encoder, args.vocab_bpe)
 
 	# load model
 	if args.model_path.split('.')[-1] == 'h5':
-		model = keras.models.load_model(
-			args.model_path,
-			custom_objects={'EmbeddingSim': EmbeddingSim,
-							'EmbeddingRet': EmbeddingRet,
-							'PositionEmbedding': PositionEmbedding,
-							'LayerNormalization': LayerNormalization,
-							'ScaledDotProductAttention': ScaledDotProductAttention,
-							'MultiHeadAttention': MultiHeadAttention,
-							'FeedForward': FeedForward,
-							'gelu': gelu,
-							'loss': net.loss})
+		model = net.create_model(args, past=True, precision=args.precision, quantized=args.quantized)
+		model = net.load_h5_weights(model, args.model_path)
+	elif args.model_path.split('.')[-1] == 'gptw':
+		model = net.create_model(args, past=True, precision=args.precision, quantized=args.quantized)
+		model = net.load_flat_weights(model, args.model_path)
 	elif args.model_path.split('.')[-1] == 'ckpt':
 		args.model_ckpt = args.model_path
-		model = net.create_model(args)
+		model = net.create_model(args, past=True, precision=args.precision)
 		model = net.load_weights(model, args)
-		model.compile(
-			optimizer=keras.optimizers.Adam(),
-			loss=net.loss
-		)
 	else:
 		print('Unrecognized model format: ' + args.model_path.split('.')[-1])
 		exit()
 
-		model.trainable = False    
+	model.trainable = False
 
 	# prepare input data
-	input_data = [enc.encode(args.starter)] * args.batch_size    
-	start_length = [len(data) for data in input_data]
+	context = enc.encode(args.starter)
+	input_data = [list(context) for _ in range(args.batch_size)]
+	start_length = len(context)
 	flag_stop = [False] * args.batch_size
-	stop = False
-		
+	# every row stops at the first token that contains a line break or at a stop string
+	stop_tokens = stopping.StopTokens(enc, args.batch_size, newline=True, sequences=args.stop)
+
+	if args.graph_loop:
+		# rows stop on the graph instead, only single tokens are checked there
+		run = generate.build_generate(model, args.output_length, stop_tokens=stop_tokens.token_ids())
+		if args.nucleus:
+			tokens = run(input_data, args.temperature, top_p=args.top_p, seed=args.seed)
+		else:
+			tokens = run(input_data, args.temperature, top_k=args.top_k, seed=args.seed)
+		print(enc.decode(context + [int(token) for token in tokens[-1] if token != 50256]))
+		return
+
+	if args.beams > 0:
+		# batch_size does not apply, all beams run as one batch
+		results = generate.beam_search(model, context, args.beams, args.output_length, args.length_penalty, args.n_best)
+		for score, tokens in results:
+			print('[score %.4f]' % score)
+			print(enc.decode(context + tokens))
+			print()
+		return
+
+	if args.nucleus:
+		settings = dict(temperature=args.temperature, top_p=args.top_p)
+	else:
+		settings = dict(temperature=args.temperature, top_k=args.top_k)
+
+	rng = np.random.RandomState(args.seed)
+
+	# the prompt runs once, afterwards only the newest tokens go through the model
+	if args.draft_model_dir:
+		draft_model = net.load_checkpoint_model(args.draft_model_dir, precision=args.precision)
+		stats = speculative.SpeculativeStats()
+		tokens = speculative.sample_tokens(model, draft_model, context, args.batch_size, args.draft_length, rng=rng, stats=stats, **settings)
+	else:
+		stats = None
+		tokens = generate.sample_tokens(model, context, args.batch_size, rng=rng, **settings)
+
+	# the last row is decoded one token at a time and printed as it comes
+	stream = enc.stream_decoder()
+	print(args.starter, end='', flush=True)
+
 	# run inference
-	for shift in range(args.output_length):
-		output_data = model.predict(np.array(input_data), batch_size=2)
+	for shift, next_tokens in zip(range(args.output_length), tokens):
 		for index in range(args.batch_size):
 			if not flag_stop[index]:
-				probs = [(prob, i) for i, prob in enumerate(output_data[index, start_length[index] + shift - 1])]
-				probs.sort(reverse=True)
-				if args.nucleus:
-					next_token = utils.find_top_p(probs, args.top_p, args.temperature)
-				else:
-					next_token = utils.find_top_p(probs, args.top_k, args.temperature)
+				next_token = int(next_tokens[index])
 				input_data[index].append(next_token)
 				if next_token == 50256:
 					flag_stop[index] = True
 			else:
 				input_data[index].append(50256)
-			
-			output = enc.decode(input_data[index])
-			if '\n' in output:
-				stop = True
-		
-		if stop:
+
+		print(stream.decode(input_data[-1][-1:]), end='', flush=True)
+
+		if stop_tokens.update([data[-1] for data in input_data]).any():
 			break
-			
-	print(output)
+
+	print(stream.flush())
+
+	if stats is not None:
+		print('speculative decoding: ' + str(stats))
 	
 if __name__ == '__main__':
 	main()
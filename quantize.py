@@ -0,0 +1,114 @@
+import time
+import argparse
+
+import numpy as np
+
+from src import encoder
+from src import net
+from src import generate
+from src import quantization
+
+parser = argparse.ArgumentParser(description='Input argument parser.')
+
+parser.add_argument('--model_dir', type=str, help='path of model folder')
+
+parser.add_argument('--custom_model', type=str, help='path to custom model')
+
+parser.add_argument('--output_name', type=str, help='path of the quantized .h5 model')
+
+parser.add_argument('--eval_path', type=str, help='held-out text file to compare the perplexity of both models on')
+
+parser.add_argument('--eval_length', type=int, help='number of tokens in every evaluated window',
+                    default=1024)
+
+parser.add_argument('--eval_windows', type=int, help='maximum number of windows evaluated',
+                    default=8)
+
+parser.add_argument('--bench_steps', type=int, help='number of decoding steps timed for both models, 0 skips it',
+                    default=64)
+
+args = parser.parse_args()
+
+#python quantize.py --model_dir=models/355M/ --output_name=output/355M_int8.h5 --eval_path=dataset/touhou.txt
+
+
+def load_model(args, quantized=False):
+    model = net.create_model(args, past=True, quantized=quantized)
+    if quantized:
+        return model
+    if args.model_path.split('.')[-1] == 'h5':
+        model = net.load_h5_weights(model, args.model_path)
+    elif args.model_path.split('.')[-1] == 'gptw':
+        model = net.load_flat_weights(model, args.model_path)
+    elif args.model_path.split('.')[-1] == 'ckpt':
+        args.model_ckpt = args.model_path
+        model = net.load_weights(model, args)
+    else:
+        print('Unrecognized model format: ' + args.model_path.split('.')[-1])
+        exit()
+    return model
+
+
+def perplexity(model, windows):
+    # Mean negative log likelihood of every token given the ones before it in its window
+    nll, count = 0.0, 0
+    for window in windows:
+        logits, _ = generate.step(model, np.array([window]), np.zeros(1), generate.empty_past(model, 1))
+        log_probs = generate._log_softmax(logits[0, :-1])
+        nll -= np.sum(log_probs[np.arange(len(window) - 1), window[1:]])
+        count += len(window) - 1
+    return float(np.exp(nll / count))
+
+
+def decode_time(model, steps):
+    # Seconds per step of one token on top of a growing cache, after one untimed step
+    steps = min(steps, model.get_layer(name='Embed-Token-Pos').input_dim - 1)
+    past = generate.empty_past(model, 1)
+    _, past = generate.step(model, np.zeros((1, 1), dtype=np.int32), np.zeros(1), past)
+    start = time.time()
+    for i in range(steps):
+        _, past = generate.step(model, np.zeros((1, 1), dtype=np.int32), np.full(1, i + 1), past)
+    return (time.time() - start) / steps
+
+
+def main():
+    if not args.model_dir or not args.output_name:
+        print('model_dir and output_name must be provided.')
+        print('quit program.')
+        exit()
+
+    if args.custom_model:
+        args.model_path = args.custom_model
+    else:
+        args.model_path = args.model_dir + "model.ckpt"
+
+    args.json_hparams = args.model_dir + "hparams.json"
+    args.json_encoder = args.model_dir + "encoder.json"
+    args.vocab_bpe = args.model_dir + "vocab.bpe"
+
+    model = load_model(args)
+    quantized_model = quantization.quantize_model(model, load_model(args, quantized=True))
+    quantized_model.save_weights(args.output_name)
+    print('saved ' + args.output_name)
+
+    print('weights: %.1f MB float32, %.1f MB int8' % (
+        quantization.weight_bytes(model) / 2 ** 20, quantization.weight_bytes(quantized_model) / 2 ** 20))
+
+    if args.eval_path:
+        enc = encoder.get_encoder(args.json_encoder, args.vocab_bpe)
+        with open(args.eval_path, encoding='utf-8', errors='ignore') as f:
+            tokens = enc.encode(f.read())
+        windows = [tokens[i:i + args.eval_length] for i in range(0, len(tokens) - 1, args.eval_length)]
+        windows = [window for window in windows if len(window) > 1][:args.eval_windows]
+        ppl, quantized_ppl = perplexity(model, windows), perplexity(quantized_model, windows)
+        print('perplexity on %d tokens: %.4f float32, %.4f int8 (%+.2f%%)' % (
+            sum(len(window) for window in windows), ppl, quantized_ppl, 100.0 * (quantized_ppl / ppl - 1.0)))
+
+    if args.bench_steps > 0:
+        step_time, quantized_step_time = decode_time(model, args.bench_steps), decode_time(quantized_model, args.bench_steps)
+        print('decoding: %.2f ms per token float32, %.2f ms per token int8' % (
+            1000 * step_time, 1000 * quantized_step_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+import json
+import asyncio
+import argparse
+import threading
+from concurrent.futures import Future
+
+from src import generate
+from src import stopping
+
+from story import init_model
+
+parser = argparse.ArgumentParser(description='Input argument parser.')
+
+parser.add_argument('--model_dir', type=str, help='path of model folder')
+
+parser.add_argument('--custom_model', type=str, help='path to custom model')
+
+parser.add_argument('--host', type=str, help='address the server listens on',
+                    default='127.0.0.1')
+
+parser.add_argument('--port', type=int, help='port the server listens on',
+                    default=8000)
+
+parser.add_argument('--output_length', type=int, help='number of tokens generated when a request does not set max_tokens',
+                    default=100)
+
+parser.add_argument('--max_batch_size', type=int, help='maximum number of requests generated together',
+                    default=8)
+
+parser.add_argument('--prefix_cache_mb', type=int, help='memory budget in megabytes for reusing the computed prompts between requests, 0 disables it',
+                    default=512)
+
+parser.add_argument('--bucket_step', type=int, help='cached lengths are padded to multiples of this, only worth it where kernels are tuned for every shape. 0 disables it',
+                    default=0)
+
+parser.add_argument('--precision', type=str, help='dtype of the weights and matrix products, the normalization, softmax and logits stay in float32',
+                    default='float32', choices=['float32', 'float16', 'bfloat16'])
+
+parser.add_argument('--quantized', help='the custom .h5 or .gptw model holds int8 weights written by quantize.py', action='store_true')
+
+parser.add_argument('--gpu_index', type=int, help='which GPU to run the model on', default=None)
+
+parser.add_argument('--gpu_max_mem', type=int, help='sets max GPU VRAM usage in megabytes', default=4096)
+
+args = parser.parse_args()
+
+#python server.py --model_dir=models/355M/
+#curl -N localhost:8000/v1/completions -d '{"prompt": "Hello, Yukari!", "max_tokens": 50, "stream": true}'
+
+END_TOKEN = 50256
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class RequestError(Exception):
+
+    def __init__(self, status, message):
+        super(RequestError, self).__init__(message)
+        self.status = status
+
+
+def parse_settings(body):
+    # Body of a completion request -> keyword arguments of complete()
+    try:
+        request = json.loads(body.decode('utf8'))
+    except ValueError:
+        raise RequestError(400, 'the body must be a json object')
+    if not isinstance(request, dict) or not isinstance(request.get('prompt'), str):
+        raise RequestError(400, 'prompt must be a string')
+    stop = request.get('stop') or []
+    if isinstance(stop, str):
+        stop = [stop]
+    try:
+        settings = dict(
+            prompt=request['prompt'],
+            max_tokens=int(request.get('max_tokens', args.output_length)),
+            temperature=float(request.get('temperature', 1.0)),
+            top_k=int(request.get('top_k', 0)),
+            top_p=float(request.get('top_p', 1.0)),
+            seed=None if request.get('seed') is None else int(request['seed']),
+            stop=[str(sequence) for sequence in stop],
+            newline=bool(request.get('newline', False)),
+        )
+    except (TypeError, ValueError) as e:
+        raise RequestError(400, str(e))
+    # Written so that NaN fails them too
+    if not settings['temperature'] >= 0:
+        raise RequestError(400, 'temperature must be at least 0')
+    if not 0 < settings['top_p'] <= 1:
+        raise RequestError(400, 'top_p must be in (0, 1]')
+    if settings['top_k'] < 0:
+        raise RequestError(400, 'top_k must be at least 0')
+    if settings['temperature'] == 0:
+        # Greedy, the most likely token every time
+        settings.update(temperature=1.0, top_k=1)
+    return settings, bool(request.get('stream', False))
+
+
+def complete(on_text, prompt, max_tokens, temperature, top_k, top_p, seed, stop, newline):
+    # Queue the prompt on args.engine, where it is decoded together with the other requests in flight.
+    # on_text is called from the engine thread with every newly decoded piece of the output. Returns an asyncio
+    # future resolved with the token counts and the finish reason after the last piece, and an event that finishes
+    # the request at the next token once it is set.
+    n_ctx = args.model.get_layer(name='Embed-Token-Pos').input_dim
+    max_tokens = min(max(max_tokens, 1), n_ctx - 1)
+    # An empty prompt starts from the end token, like the unconditional samples of GPT-2
+    tokens = generate.fit_window([], args.enc.encode(prompt) or [END_TOKEN], n_ctx - max_tokens)
+
+    cancelled = threading.Event()
+    stop_tokens = stopping.StopTokens(args.enc, 1, newline=newline, sequences=stop)
+    stream = args.enc.stream_decoder()
+
+    def stop_request(output):
+        return cancelled.is_set() or bool(stop_tokens.update(output[-1:])[0])
+
+    def on_token(token):
+        text = stream.decode([token])
+        if text:
+            on_text(text)
+
+    future = Future()
+
+    def done(tokens_future):
+        try:
+            output = tokens_future.result()
+        except Exception as e:
+            future.set_exception(e)
+            return
+        text = stream.flush()
+        if text:
+            on_text(text)
+        stopped = output[-1] == END_TOKEN or stop_tokens.stopped[0]
+        future.set_result({
+            'prompt_tokens': len(tokens),
+            'completion_tokens': len([token for token in output if token != END_TOKEN]),
+            'finish_reason': 'stop' if stopped else 'length',
+        })
+
+    args.engine.submit(
+        tokens,
+        max_tokens,
+        temperature=temperature,
+        top_k=top_k,
+        top_p=top_p,
+        seed=seed,
+        stop=stop_request,
+        on_token=on_token,
+    ).add_done_callback(done)
+
+    return asyncio.wrap_future(future), cancelled
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    try:
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise RequestError(400, 'malformed request line')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+    except (ValueError, asyncio.IncompleteReadError):
+        raise RequestError(400, 'malformed body')
+    return method, path.split('?')[0], body
+
+
+def write_head(writer, status, content_type, length=None):
+    head = ['HTTP/1.1 %d %s' % (status, STATUS[status]), 'Content-Type: ' + content_type, 'Connection: close']
+    if length is None:
+        head.append('Cache-Control: no-cache')
+    else:
+        head.append('Content-Length: %d' % length)
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+
+
+def write_json(writer, status, value):
+    body = json.dumps(value).encode('utf8')
+    write_head(writer, status, 'application/json', len(body))
+    writer.write(body)
+
+
+def write_event(writer, value):
+    writer.write(b'data: ' + json.dumps(value).encode('utf8') + b'\n\n')
+
+
+async def stream_completion(writer, settings):
+    # Server-sent events, one per decoded piece of text, then one with the finish reason and the usage
+    loop = asyncio.get_event_loop()
+    pieces = asyncio.Queue()
+    future, cancelled = complete(lambda text: loop.call_soon_threadsafe(pieces.put_nowait, text), **settings)
+    # The pieces and the result are handed over in order, so None follows the last piece
+    future.add_done_callback(lambda _: pieces.put_nowait(None))
+    write_head(writer, 200, 'text/event-stream')
+    try:
+        text = await pieces.get()
+        while text is not None:
+            write_event(writer, {'text': text})
+            await writer.drain()
+            text = await pieces.get()
+        try:
+            write_event(writer, await future)
+        except Exception as e:
+            write_event(writer, {'error': repr(e)})
+        writer.write(b'data: [DONE]\n\n')
+    except ConnectionError:
+        # The client went away, free its row of the batch
+        cancelled.set()
+
+
+async def handle(reader, writer):
+    try:
+        method, path, body = await read_request(reader)
+        if path == '/health':
+            write_json(writer, 200, {'status': 'ok', 'requests': len(args.engine.rows) + args.engine.requests.qsize()})
+        elif path != '/v1/completions':
+            raise RequestError(404, 'unknown path ' + path)
+        elif method != 'POST':
+            raise RequestError(405, 'completions are requested with POST')
+        else:
+            settings, stream = parse_settings(body)
+            if stream:
+                await stream_completion(writer, settings)
+            else:
+                pieces = []
+                future, _ = complete(pieces.append, **settings)
+                completion = await future
+                completion['text'] = ''.join(pieces)
+                write_json(writer, 200, completion)
+    except RequestError as e:
+        write_json(writer, e.status, {'error': str(e)})
+    except ConnectionError:
+        pass
+    except Exception as e:
+        write_json(writer, 500, {'error': repr(e)})
+    try:
+        await writer.drain()
+        writer.close()
+    except ConnectionError:
+        pass
+
+
+async def serve():
+    server = await asyncio.start_server(handle, args.host, args.port)
+    print('serving completions on http://%s:%d/v1/completions' % (args.host, args.port))
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    # init_model also reads the settings of the bot that do not apply here
+    args.batch_size = 1
+    init_model(args)
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
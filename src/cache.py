@@ -0,0 +1,100 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+class PrefixCache(object):
+    """LRU cache of the keys and values computed for previously seen prompts.
+
+    A lookup returns the cache of the longest common prefix between the prompt and any stored prompt, so a prompt that
+    shares a long fixed head (e.g. the persona context of the bot) with an earlier one only has to compute its suffix.
+    Since attention is causal, the cache of the first `n` tokens of a stored prompt is valid for every prompt that
+    starts with the same `n` tokens.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: Memory budget of the stored keys and values. The least recently used prompts are evicted first.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.computed_tokens = 0
+
+    def get(self, tokens):
+        """Find the longest cached prefix of `tokens`.
+
+        At least the last token is left over, since its logits are needed to continue the prompt.
+
+        :param tokens: Token ids of the prompt.
+        :return: Number of cached tokens, and the cache of those tokens (None if nothing matched).
+        """
+        tokens = np.asarray(tokens)
+        best_key, best_length = None, 0
+        for key, (key_tokens, _) in self.entries.items():
+            length = _common_prefix(key_tokens, tokens[:-1])
+            if length > best_length:
+                best_key, best_length = key, length
+        if best_key is None:
+            self.misses += 1
+            self.computed_tokens += len(tokens)
+            return 0, None
+        self.entries.move_to_end(best_key)
+        self.hits += 1
+        self.reused_tokens += best_length
+        self.computed_tokens += len(tokens) - best_length
+        past = self.entries[best_key][1]
+        return best_length, [p[:, :, :best_length] for p in past]
+
+    def put(self, tokens, past):
+        """Store the cache of a prompt.
+
+        :param tokens: Token ids of the prompt.
+        :param past: Its keys and values, one tensor with batch size 1 for each layer.
+        """
+        tokens = np.asarray(tokens)
+        nbytes = _nbytes(past)
+        if nbytes > self.max_bytes:
+            return
+        for key, (key_tokens, key_past) in list(self.entries.items()):
+            length = _common_prefix(key_tokens, tokens)
+            if length == len(tokens):
+                # Already covered by a longer prompt
+                self.entries.move_to_end(key)
+                return
+            if length == len(key_tokens):
+                # Superseded by the new prompt
+                del self.entries[key]
+                self.nbytes -= _nbytes(key_past)
+        self.entries[tokens.tobytes()] = (tokens, past)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, key_past) = self.entries.popitem(last=False)
+            self.nbytes -= _nbytes(key_past)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'reused_tokens': self.reused_tokens,
+            'computed_tokens': self.computed_tokens,
+            'entries': len(self.entries),
+            'bytes': self.nbytes,
+        }
+
+
+def _common_prefix(a, b):
+    length = min(len(a), len(b))
+    mismatch = np.flatnonzero(a[:length] != b[:length])
+    return int(mismatch[0]) if mismatch.size else length
+
+
+def _nbytes(past):
+    return sum(p.shape.num_elements() * p.dtype.size for p in past)
@@ -0,0 +1,45 @@
+"""Client of the completions server in server.py.
+
+It only needs the standard library, so tools can request completions from a running server without loading
+TensorFlow or the model themselves.
+"""
+
+import json
+import urllib.request
+
+
+def _post(url, settings):
+    request = urllib.request.Request(url.rstrip('/') + '/v1/completions', data=json.dumps(settings).encode('utf8'),
+                                     headers={'Content-Type': 'application/json'})
+    return urllib.request.urlopen(request)
+
+
+def complete(url, prompt, **settings):
+    """Request a completion and wait for the whole text.
+
+    :param url: Address of the server, e.g. 'http://127.0.0.1:8000'.
+    :param prompt: Text the completion continues.
+    :param settings: `max_tokens`, `temperature`, `top_k`, `top_p`, `seed`, `stop` and `newline`, the server picks its
+                     defaults for the others.
+    :return: A dict with the `text`, the `finish_reason` ('stop' or 'length') and the token counts.
+    """
+    settings.update(prompt=prompt, stream=False)
+    with _post(url, settings) as response:
+        return json.loads(response.read().decode('utf8'))
+
+
+def stream(url, prompt, **settings):
+    """Same as `complete`, but yields the events of the completion as they are sent.
+
+    Every event but the last one holds a piece of the `text`, the last one holds the `finish_reason` and the token
+    counts, or an `error`.
+    """
+    settings.update(prompt=prompt, stream=True)
+    with _post(url, settings) as response:
+        for line in response:
+            line = line.decode('utf8').strip()
+            if not line.startswith('data: '):
+                continue
+            if line == 'data: [DONE]':
+                return
+            yield json.loads(line[len('data: '):])
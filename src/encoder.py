@@ -2,7 +2,10 @@
 
 import os
 import json
+import codecs
+import heapq
 import regex as re
+from collections import OrderedDict
 from functools import lru_cache
 
 @lru_cache()
@@ -39,60 +42,100 @@ def get_pairs(word):
         prev_char = char
     return pairs
 
+class StreamDecoder:
+    """Decodes tokens as they are generated.
+
+    Bytes of a character split over several tokens are held back until the character is complete,
+    so every call only returns the newly completed text.
+    """
+    def __init__(self, token_bytes, errors='replace'):
+        self.token_bytes = token_bytes
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors=errors)
+
+    def decode(self, tokens):
+        return self.decoder.decode(b''.join(self.token_bytes[token] for token in tokens))
+
+    def flush(self):
+        """Returns what is left of an incomplete character at the end of the stream."""
+        return self.decoder.decode(b'', final=True)
+
 class Encoder:
-    def __init__(self, encoder, bpe_merges, errors='replace'):
+    def __init__(self, encoder, bpe_merges, errors='replace', cache_size=2**16):
         self.encoder = encoder
         self.decoder = {v:k for k,v in self.encoder.items()}
         self.errors = errors # how to handle errors in decoding
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v:k for k, v in self.byte_encoder.items()}
+        # utf-8 bytes of every token, indexed by token id
+        self.token_bytes = [b''] * (max(self.decoder) + 1)
+        for token, text in self.decoder.items():
+            self.token_bytes[token] = bytes(self.byte_decoder[c] for c in text)
         self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        # LRU cache of the merged words, the least recently used ones are evicted past cache_size entries
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
 
         # Should haved added re.IGNORECASE so BPE merges can happen for capitalized versions of contractions
         self.pat = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
 
     def bpe(self, token):
         if token in self.cache:
+            self.cache_hits += 1
+            self.cache.move_to_end(token)
             return self.cache[token]
-        word = tuple(token)
-        pairs = get_pairs(word)
-
-        if not pairs:
-            return token
-
-        while True:
-            bigram = min(pairs, key = lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word)-1 and word[i+1] == second:
-                    new_word.append(first+second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = ' '.join(word)
+        self.cache_misses += 1
+        word = ' '.join(self.merge(token))
         self.cache[token] = word
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
         return word
 
+    def merge(self, token):
+        """Apply the merges to the characters of a token, lowest rank first, and return the resulting symbols.
+
+        The symbols form a linked list and the adjacent pairs that can merge wait in a heap ordered by rank, then by
+        position, so each merge only updates its neighbours instead of scanning the whole word again. A merge always
+        ranks after the merges that built its symbols, so this picks the same pairs as merging all occurrences of the
+        best pair of the word at a time, from left to right.
+        """
+        symbols = list(token)
+        # Symbols merged into their left neighbour are None, the others keep the position of their first character
+        left = list(range(-1, len(symbols) - 1))
+        right = list(range(1, len(symbols) + 1))
+        heap = []
+
+        def push(i, j):
+            rank = self.bpe_ranks.get((symbols[i], symbols[j]))
+            if rank is not None:
+                heapq.heappush(heap, (rank, i, j))
+
+        for i in range(len(symbols) - 1):
+            push(i, i + 1)
+        while heap:
+            rank, i, j = heapq.heappop(heap)
+            # Skip pairs that changed since they were pushed
+            if right[i] != j or symbols[i] is None or self.bpe_ranks.get((symbols[i], symbols[j])) != rank:
+                continue
+            symbols[i] += symbols[j]
+            symbols[j] = None
+            right[i] = right[j]
+            if right[i] < len(symbols):
+                left[right[i]] = i
+                push(i, right[i])
+            if left[i] >= 0:
+                push(left[i], i)
+        return [symbol for symbol in symbols if symbol is not None]
+
+    def cache_stats(self):
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'hit_rate': self.cache_hits / max(self.cache_hits + self.cache_misses, 1),
+            'entries': len(self.cache),
+        }
+
     def encode(self, text):
         bpe_tokens = []
         for token in re.findall(self.pat, text):
@@ -101,9 +144,10 @@ class Encoder:
         return bpe_tokens
 
     def decode(self, tokens):
-        text = ''.join([self.decoder[token] for token in tokens])
-        text = bytearray([self.byte_decoder[c] for c in text]).decode('utf-8', errors=self.errors)
-        return text
+        return b''.join(self.token_bytes[token] for token in tokens).decode('utf-8', errors=self.errors)
+
+    def stream_decoder(self):
+        return StreamDecoder(self.token_bytes, errors=self.errors)
 
 def get_encoder(json_encoder, vocab_bpe):
     with open(json_encoder, 'r') as f:
@@ -0,0 +1,199 @@
+"""Continuous batching of generation requests.
+
+Requests are prefilled one by one as they arrive, then decoded together: every step feeds the newest token of all rows
+in flight through the model at once. Rows with a shorter history are padded on the left and masked, so requests can
+join and leave the batch between any two steps. A request whose window fills the context of the model either finishes
+or, if it pins its leading tokens, drops the oldest tokens after them and is prefilled again with the rest.
+"""
+
+import queue
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+import tensorflow as tf
+
+from src import generate
+from src import utils
+
+
+class Request(object):
+    """A prompt waiting for or being decoded by the engine."""
+
+    def __init__(self, tokens, output_length, temperature=1.0, top_k=0, top_p=1.0, seed=None, stop=None, on_token=None,
+                 pinned=None):
+        """
+        :param tokens: Token ids of the prompt.
+        :param output_length: Maximum number of tokens generated.
+        :param temperature: Softmax temperature.
+        :param top_k: Top K sampling cut off, 0 disables it.
+        :param top_p: Nucleus sampling cut off, 1.0 disables it.
+        :param seed: Seed of the random state of the request.
+        :param stop: Optional callable that takes the generated token ids and returns True to finish the request.
+        :param on_token: Optional callable that receives every generated token id except the end token as soon as it
+                         is sampled. It is called from the thread of the engine.
+        :param pinned: Number of leading tokens of the prompt that are always kept, e.g. the persona context. Once the
+                       window is full, the oldest tokens after them are dropped to make room. None finishes the request
+                       instead.
+        """
+        self.tokens = list(tokens)
+        self.start_length = len(self.tokens)
+        # Tokens in the window of the model, the end of `tokens` once the window has slid
+        self.window = list(tokens)
+        self.pinned = pinned
+        self.finished = False
+        self.output_length = output_length
+        self.temperature = temperature
+        self.top_k = int(top_k)
+        self.top_p = top_p
+        self.rng = np.random.RandomState(seed)
+        self.stop = stop
+        self.on_token = on_token
+        self.future = Future()
+
+    @property
+    def output(self):
+        return self.tokens[self.start_length:]
+
+
+class Engine(object):
+    """Generation engine that shares one batched forward step between all requests in flight."""
+
+    def __init__(self, model, max_batch_size=8, end_token=50256, prefix_cache=None, evict=None):
+        """
+        :param model: Model built with `create_model(args, past=True)`.
+        :param max_batch_size: Maximum number of requests decoded together.
+        :param end_token: Token that finishes a request.
+        :param prefix_cache: Optional `cache.PrefixCache` used when prefilling the prompts and the slid windows.
+        :param evict: Number of tokens a full window drops at once, defaults to a quarter of the context size.
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.end_token = end_token
+        self.prefix_cache = prefix_cache
+        self.n_ctx = model.get_layer(name='Embed-Token-Pos').input_dim
+        self.evict = evict if evict is not None else self.n_ctx // 4
+        self.requests = queue.Queue()
+        self.rows = []
+        self.past = None
+        self.key_mask = None
+        self.thread = threading.Thread(target=self._loop, name='engine', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def submit(self, tokens, output_length, **kwargs):
+        """Queue a prompt for generation.
+
+        :return: A `concurrent.futures.Future` resolved with the generated token ids.
+        """
+        request = Request(tokens, output_length, **kwargs)
+        self.requests.put(request)
+        return request.future
+
+    def _loop(self):
+        while True:
+            # Block while idle, otherwise only pick up what is already waiting
+            while len(self.rows) < self.max_batch_size:
+                try:
+                    request = self.requests.get(block=not self.rows)
+                except queue.Empty:
+                    break
+                if request is None:
+                    return
+                self._admit(request)
+            if self.rows:
+                self._step()
+
+    def _admit(self, request):
+        try:
+            logits, past = generate.prefill(self.model, request.window, self.prefix_cache)
+        except Exception as e:
+            request.future.set_exception(e)
+            return
+        self.rows.append(request)
+        if self.past is None:
+            self.past, self.key_mask = past, np.ones((1, len(request.window)), dtype=np.float32)
+        else:
+            # Pad the shorter side on the left so all rows end at the same cache position
+            length, batch_length = len(request.window), self.key_mask.shape[1]
+            key_mask = np.ones((1, length), dtype=np.float32)
+            if length < batch_length:
+                past = [generate.pad_past(p, batch_length - length) for p in past]
+                key_mask = np.pad(key_mask, ((0, 0), (batch_length - length, 0)))
+            elif length > batch_length:
+                self.past = [generate.pad_past(p, length - batch_length) for p in self.past]
+                self.key_mask = np.pad(self.key_mask, ((0, 0), (length - batch_length, 0)))
+            self.past = [tf.concat([p, q], axis=0) for p, q in zip(self.past, past)]
+            self.key_mask = np.concatenate([self.key_mask, key_mask])
+        self._sample(logits, [request])
+
+    def _step(self):
+        tokens = np.array([request.window[-1:] for request in self.rows])
+        offset = np.array([len(request.window) - 1 for request in self.rows])
+        key_mask = np.concatenate([self.key_mask, np.ones((len(self.rows), 1), dtype=np.float32)], axis=1)
+        try:
+            logits, self.past = generate.step(self.model, tokens, offset, self.past, key_mask)
+        except Exception as e:
+            for request in self.rows:
+                request.future.set_exception(e)
+            self.rows, self.past, self.key_mask = [], None, None
+            return
+        self.key_mask = key_mask
+        self._sample(logits[:, -1], self.rows)
+
+    def _sample(self, logits, rows):
+        """Append the next token to the last `len(rows)` rows of the batch, retire the finished ones and slide the full
+        windows."""
+        next_tokens = utils.sample_logits(
+            logits,
+            temperature=[request.temperature for request in rows],
+            top_k=[request.top_k for request in rows],
+            top_p=[request.top_p for request in rows],
+            rng=[request.rng for request in rows],
+        )
+        for request, next_token in zip(rows, next_tokens):
+            request.tokens.append(int(next_token))
+            request.window.append(int(next_token))
+            if request.on_token is not None and next_token != self.end_token:
+                request.on_token(int(next_token))
+            # Checked once per token, the stop condition may keep a state
+            request.finished = self._finished(request)
+
+        keep = np.array([not request.finished and len(request.window) <= self.n_ctx for request in self.rows])
+        if all(keep):
+            return
+        sliding = []
+        for request, k in zip(self.rows, keep):
+            if request.finished:
+                request.future.set_result(request.output)
+            elif not k:
+                sliding.append(request)
+        self.rows = [request for request, k in zip(self.rows, keep) if k]
+        if not self.rows:
+            self.past, self.key_mask = None, None
+        else:
+            # Drop the retired rows and the padding that only they needed
+            start = int(np.argmax(self.key_mask[keep].max(axis=0) > 0))
+            self.past = [tf.boolean_mask(p, keep)[:, :, start:] for p in self.past]
+            self.key_mask = self.key_mask[keep][:, start:]
+        # Same window as `generate.sample_tokens_window`. The positions are absolute, so the tokens that move down are
+        # run again
+        for request in sliding:
+            keep_length = self.n_ctx - self.evict - request.pinned
+            request.window = request.window[:request.pinned] + request.window[-keep_length:]
+            self._admit(request)
+
+    def _finished(self, request):
+        output = request.output
+        if output[-1] == self.end_token or len(output) >= request.output_length:
+            return True
+        if request.pinned is None and len(request.window) >= self.n_ctx:
+            return True
+        return request.stop is not None and request.stop(output)
+
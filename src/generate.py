@@ -0,0 +1,424 @@
+import numpy as np
+import tensorflow as tf
+
+from src import utils
+
+
+def empty_past(model, batch_size):
+    """Zero-length key/value cache for every layer of a model built with `create_model(args, past=True)`."""
+    past = []
+    for past_input in model.inputs[4:]:
+        _, _, _, head_num, head_dim = past_input.shape.as_list()
+        past.append(tf.zeros((batch_size, 2, 0, head_num, head_dim), dtype=past_input.dtype))
+    return past
+
+
+def pad_past(past, length):
+    """Pad the cache of one layer on the left with `length` masked positions."""
+    return tf.pad(past, [[0, 0], [0, 0], [length, 0], [0, 0], [0, 0]])
+
+
+class LengthBuckets(object):
+    """Small set of input shapes that every step of a model is padded to.
+
+    The new tokens are padded on the right up to the next of `query_lengths`, and the cache on the left up to a multiple
+    of `key_step`. Both paddings are masked out, and `step` strips them from its results again. The step function is
+    traced once for all shapes anyway, so this only pays off where the kernels are tuned for every shape they see; it
+    costs padded compute everywhere else.
+    """
+
+    def __init__(self, n_ctx, query_lengths=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024), key_step=64):
+        self.n_ctx = n_ctx
+        self.query_lengths = sorted(length for length in query_lengths if length <= n_ctx)
+        self.key_step = key_step
+
+    def query_length(self, length):
+        return next((bucket for bucket in self.query_lengths if bucket >= length), length)
+
+    def key_length(self, length):
+        return -(-length // self.key_step) * self.key_step
+
+
+def use_buckets(model, **kwargs):
+    """Pad every `step` of a model built with `create_model(args, past=True)` to `LengthBuckets(**kwargs)`."""
+    model.length_buckets = LengthBuckets(model.get_layer(name='Embed-Token-Pos').input_dim, **kwargs)
+    return model.length_buckets
+
+
+def warm_up(model):
+    """Trace the step function of a model once, so that the first request does not pay for it.
+
+    The trace leaves the batch size and the lengths open, so one step covers every shape.
+    """
+    step(model, np.zeros((1, 1), dtype=np.int32), np.zeros(1), empty_past(model, 1))
+
+
+def _step_function(model):
+    """The forward pass of an incremental model as one `tf.function`, traced once with the batch size and the lengths left
+    open.
+
+    The cache is padded on the left by `pad_left` inside the function and the padding is cut off the new cache again,
+    so the keys and values never leave the device between steps. Only the logits are copied back.
+    """
+    function = getattr(model, 'step_function', None)
+    if function is not None:
+        return function
+
+    input_specs = [tf.TensorSpec([None] * len(model_input.shape), model_input.dtype) for model_input in model.inputs[:4]]
+    past_specs = [tf.TensorSpec([None, 2, None] + past_input.shape.as_list()[3:], past_input.dtype)
+                  for past_input in model.inputs[4:]]
+
+    @tf.function(input_signature=[input_specs, past_specs, tf.TensorSpec([], tf.int32), tf.TensorSpec([], tf.int32)])
+    def function(inputs, past, pad_left, length):
+        outputs = model(inputs + [pad_past(p, pad_left) for p in past], training=False)
+        return outputs[0], [present[:, :, pad_left:pad_left + length] for present in outputs[1:]]
+
+    model.step_function = function
+    return function
+
+
+def step(model, tokens, offset, past, key_mask=None, last=None):
+    """Run the new tokens through the model on top of the cached keys and values.
+
+    The model has to run eagerly. The cache stays on the device as a list of tensors, which `tf` ops can slice, pad,
+    gather and concatenate between steps.
+
+    :param model: Model built with `create_model(args, past=True)`.
+    :param tokens: Integer array with shape `(batch_size, seq_len)` holding only the tokens not seen yet.
+    :param offset: Integer array with shape `(batch_size,)`, the position of the first of `tokens` in every row.
+    :param past: List of cached keys and values, one tensor for each layer.
+    :param key_mask: Array with shape `(batch_size, past_len + seq_len)`, 0 for padding. Defaults to all ones.
+    :param last: Only compute the logits of the last `last` new tokens. Defaults to all of them.
+    :return: Logits of the new tokens with shape `(batch_size, last, n_vocab)`, and the updated cache.
+    """
+    tokens = np.asarray(tokens)
+    offset = np.asarray(offset, dtype=np.int32)
+    batch_size, seq_len = tokens.shape
+    past_len = past[0].shape[2]
+    if key_mask is None:
+        key_mask = np.ones((batch_size, past_len + seq_len), dtype=np.float32)
+    if last is None:
+        last = seq_len
+    logits_index = np.tile(np.arange(seq_len - last, seq_len, dtype=np.int32), (batch_size, 1))
+
+    pad_left, pad_right = 0, 0
+    buckets = getattr(model, 'length_buckets', None)
+    if buckets is not None:
+        # The padded tokens still need a position, so they stop at the end of the context
+        pad_right = max(min(buckets.query_length(seq_len), buckets.n_ctx - int(offset.max())) - seq_len, 0)
+        key_len = past_len + seq_len + pad_right
+        pad_left = buckets.key_length(key_len) - key_len
+        tokens = np.pad(tokens, ((0, 0), (0, pad_right)))
+        key_mask = np.pad(key_mask, ((0, 0), (pad_left, pad_right)))
+
+    inputs = [tf.constant(value, dtype=model_input.dtype)
+              for value, model_input in zip([tokens, offset, key_mask, logits_index], model.inputs)]
+    logits, past = _step_function(model)(inputs, past, tf.constant(pad_left), tf.constant(past_len + seq_len))
+    return logits.numpy(), past
+
+
+def prefill(model, tokens, prefix_cache=None):
+    """Run a prompt through the model, reusing the cache of its longest known prefix.
+
+    :param model: Model built with `create_model(args, past=True)`.
+    :param tokens: Token ids of the prompt.
+    :param prefix_cache: Optional `cache.PrefixCache`, which also receives the cache of the prompt.
+    :return: Logits of the last token with shape `(1, n_vocab)`, and the cache of the prompt with batch size 1.
+    """
+    length, past = 0, None
+    if prefix_cache is not None:
+        length, past = prefix_cache.get(tokens)
+    if past is None:
+        past = empty_past(model, 1)
+    logits, past = step(model, np.array([tokens[length:]]), np.array([length]), past, last=1)
+    if prefix_cache is not None:
+        prefix_cache.put(tokens, past)
+    return logits[:, -1], past
+
+
+def sample_tokens(model, context, batch_size, temperature=1.0, top_k=0, top_p=1.0, rng=None, prefix_cache=None):
+    """Sample continuations of a prompt one position at a time.
+
+    The prompt is prefilled once and repeated for every row, afterwards each step only feeds the newest tokens.
+
+    :param model: Model built with `create_model(args, past=True)`.
+    :param context: Token ids of the prompt.
+    :param batch_size: Number of continuations sampled together.
+    :param prefix_cache: Optional `cache.PrefixCache` used for the prompt.
+    :return: Generator yielding the next token of every row as an integer array with shape `(batch_size,)`, for as
+             long as the caller keeps iterating.
+    """
+    logits, past = prefill(model, context, prefix_cache)
+    logits = np.repeat(logits, batch_size, axis=0)
+    past = [tf.repeat(p, batch_size, axis=0) for p in past]
+    offset = len(context)
+    while True:
+        next_tokens = utils.sample_logits(logits, temperature, top_k=top_k, top_p=top_p, rng=rng)
+        yield next_tokens
+        logits, past = step(model, next_tokens[:, None], np.full(batch_size, offset), past)
+        logits = logits[:, -1]
+        offset += 1
+
+
+def fit_window(pinned, context, length):
+    """Drop the oldest tokens of `context` so that `pinned + context` holds at most `length` tokens.
+
+    :param pinned: Token ids that are always kept, e.g. the persona context.
+    :param context: Token ids following them, the conversation so far.
+    :return: Token ids of the whole prompt.
+    """
+    keep = length - len(pinned)
+    if keep <= 0:
+        raise ValueError('The pinned prefix of %d tokens leaves no room in a window of %d' % (len(pinned), length))
+    return list(pinned) + list(context)[-keep:]
+
+
+def sample_tokens_window(model, pinned, context, batch_size, temperature=1.0, top_k=0, top_p=1.0, rng=None,
+                         prefix_cache=None, evict=None):
+    """Same as `sample_tokens`, but keeps going past the context size of the model.
+
+    Whenever the window is full, the oldest `evict` tokens after `pinned` are dropped and the rest moves down to the
+    positions right after `pinned`. The positions are learned and absolute, so the keys and values of the tokens that
+    moved can not be reused and the window has to be run again. Dropping a whole block at once keeps that to one pass
+    every `evict` tokens, and the cache of `pinned`, which never moves, is computed once and reused.
+
+    :param pinned: Token ids at the start of the window that are never dropped.
+    :param context: Token ids of the rest of the prompt, its oldest tokens are dropped first if it does not fit.
+    :param evict: Number of tokens dropped at once, defaults to a quarter of the context size.
+    """
+    n_ctx = model.get_layer(name='Embed-Token-Pos').input_dim
+    if evict is None:
+        evict = n_ctx // 4
+    prompt = fit_window(pinned, context, n_ctx - evict)
+    start = len(pinned)
+
+    logits, past = prefill(model, prompt, prefix_cache)
+    logits = np.repeat(logits, batch_size, axis=0)
+    past = [tf.repeat(p, batch_size, axis=0) for p in past]
+    window = np.tile(np.array(prompt[start:], dtype=np.int64), (batch_size, 1))
+    pinned_past = None
+    while True:
+        next_tokens = utils.sample_logits(logits, temperature, top_k=top_k, top_p=top_p, rng=rng)
+        yield next_tokens
+        window = np.concatenate([window, next_tokens[:, None]], axis=1)
+        if start + window.shape[1] <= n_ctx:
+            logits, past = step(model, next_tokens[:, None], np.full(batch_size, start + window.shape[1] - 1), past)
+        else:
+            window = window[:, -(n_ctx - evict - start):]
+            if pinned_past is None:
+                pinned_past = prefill(model, pinned, prefix_cache)[1] if start else empty_past(model, 1)
+            past = [tf.repeat(p, batch_size, axis=0) for p in pinned_past]
+            logits, past = step(model, window, np.full(batch_size, start), past, last=1)
+        logits = logits[:, -1]
+
+
+def _log_softmax(logits):
+    logits = np.asarray(logits, dtype=np.float64)
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    return logits - np.log(np.sum(np.exp(logits), axis=-1, keepdims=True))
+
+
+def beam_search(model, context, num_beams=4, max_length=100, length_penalty=1.0, n_best=1, end_token=50256,
+                early_stopping=False, prefix_cache=None):
+    """Find the most likely continuations of a prompt with beam search.
+
+    All beams are decoded together as the rows of one batch. After every step the cache is gathered along the batch
+    dimension to follow the surviving beams, so no prefix is ever run twice. A beam is finished by `end_token`, and
+    finished beams are ranked by their total log probability divided by `length ** length_penalty`.
+
+    :param model: Model built with `create_model(args, past=True)`.
+    :param context: Token ids of the prompt.
+    :param num_beams: Number of beams kept at every step.
+    :param max_length: Maximum number of tokens generated, also bounded by the context size of the model.
+    :param length_penalty: Exponent of the length normalization, 0 ranks by total log probability and favours short
+                           outputs, larger values favour long ones.
+    :param n_best: Number of continuations returned, at most `num_beams`.
+    :param end_token: Token that finishes a beam.
+    :param early_stopping: Stop as soon as `num_beams` beams are finished, instead of once no running beam can still
+                           beat the finished ones.
+    :param prefix_cache: Optional `cache.PrefixCache` used for the prompt.
+    :return: List of `(score, tokens)` with the best first, where `tokens` excludes the prompt and the end token.
+    """
+    n_ctx = model.get_layer(name='Embed-Token-Pos').input_dim
+    max_length = min(max_length, n_ctx - len(context))
+
+    logits, past = prefill(model, context, prefix_cache)
+    logits = np.repeat(logits, num_beams, axis=0)
+    past = [tf.repeat(p, num_beams, axis=0) for p in past]
+    # Only the first beam is live at the start, otherwise every step would pick the same token num_beams times
+    scores = np.full(num_beams, -np.inf)
+    scores[0] = 0.0
+    beams = np.zeros((num_beams, 0), dtype=np.int64)
+    finished = []
+
+    def normalize(score, length):
+        return score / max(length, 1) ** length_penalty
+
+    for length in range(1, max_length + 1):
+        candidates = (_log_softmax(logits) + scores[:, None]).ravel()
+        # Twice the beams, so enough candidates survive even if half of them end here
+        k = min(2 * num_beams, candidates.size)
+        top = np.argpartition(-candidates, k - 1)[:k]
+        top = top[np.argsort(-candidates[top], kind='stable')]
+        n_vocab = logits.shape[-1]
+
+        beam_index, beam_tokens, beam_scores = [], [], []
+        for index in top:
+            source, token, score = index // n_vocab, index % n_vocab, candidates[index]
+            if score == -np.inf:
+                break
+            if token == end_token:
+                finished.append((normalize(score, length - 1), beams[source].tolist()))
+            else:
+                beam_index.append(source)
+                beam_tokens.append(token)
+                beam_scores.append(score)
+            if len(beam_index) == num_beams:
+                break
+        finished = sorted(finished, key=lambda hypothesis: -hypothesis[0])[:num_beams]
+
+        if len(finished) == num_beams:
+            if early_stopping:
+                break
+            # Scores only go down from here, so the best running beam is bounded by its current normalized score
+            # when the normalization cannot grow with the length
+            best_running = beam_scores[0] if beam_scores else -np.inf
+            bound = normalize(best_running, max_length if length_penalty > 0 else length)
+            if bound <= finished[-1][0]:
+                break
+        if not beam_index:
+            break
+
+        # Reorder the beams and their cache, then feed the new tokens
+        beam_index = np.array(beam_index)
+        beams = np.concatenate([beams[beam_index], np.array(beam_tokens)[:, None]], axis=1)
+        scores = np.array(beam_scores)
+        if length == max_length:
+            break
+        past = [tf.gather(p, beam_index) for p in past]
+        logits, past = step(model, beams[:, -1:], np.full(len(beam_index), len(context) + length - 1), past)
+        logits = logits[:, -1]
+
+    if len(finished) < n_best:
+        # Fill up with the beams that ran out of length
+        running = [(normalize(score, beams.shape[1]), beam.tolist()) for score, beam in zip(scores, beams)
+                   if score > -np.inf]
+        finished = sorted(finished + running, key=lambda hypothesis: -hypothesis[0])
+    return finished[:n_best]
+
+
+def _sample_graph(logits, temperature, top_k, top_p, seed):
+    """Graph version of `utils.sample_logits`, with the same settings for every row."""
+    logits = logits / temperature
+    n_vocab = tf.shape(logits)[-1]
+
+    def _top_k():
+        values, _ = tf.math.top_k(logits, k=tf.minimum(top_k, n_vocab))
+        return tf.where(logits < values[:, -1:], tf.fill(tf.shape(logits), -1e10), logits)
+
+    def _top_p():
+        sorted_logits = tf.sort(logits, direction='DESCENDING', axis=-1)
+        mass_before = tf.cumsum(tf.nn.softmax(sorted_logits), axis=-1, exclusive=True)
+        # The most likely token is always kept
+        keep = tf.logical_or(mass_before < top_p, tf.equal(tf.range(n_vocab), 0)[None, :])
+        cut_off = tf.reduce_min(tf.where(keep, sorted_logits, tf.fill(tf.shape(sorted_logits), 1e10)), axis=-1, keepdims=True)
+        return tf.where(logits < cut_off, tf.fill(tf.shape(logits), -1e10), logits)
+
+    logits = tf.cond(top_k > 0, _top_k, lambda: logits)
+    logits = tf.cond(top_p < 1.0, _top_p, lambda: logits)
+    return tf.cast(tf.random.stateless_categorical(logits, 1, seed=seed)[:, 0], tf.int32)
+
+
+def build_generate(model, length, end_token=50256, stop_tokens=()):
+    """Compile the whole autoregressive loop of an incremental model into one graph.
+
+    The tokens are written into a fixed-size buffer and the loop ends on the graph, once every row sampled `end_token`
+    or one of `stop_tokens`, or the buffer is full. Python is only entered once per call.
+
+    :param model: Model built with `create_model(args, past=True)`.
+    :param length: Maximum number of generated tokens.
+    :param end_token: Token that finishes a row, the rest of the row is filled with it.
+    :param stop_tokens: Further token ids that finish a row, they are kept in the output.
+    :return: `generate(context, temperature=1.0, top_k=0, top_p=1.0, seed=None)`, which takes the prompt tokens with
+             shape `(batch_size, context_len)` and returns the generated tokens with shape `(batch_size, length)`.
+    """
+    stop_tokens = tf.constant(sorted(set(stop_tokens) | {end_token}), dtype=tf.int32)
+    past_shapes = [tf.TensorShape([None, 2, None, past_input.shape[3], past_input.shape[4]])
+                   for past_input in model.inputs[4:]]
+    past_dtype = model.inputs[4].dtype
+
+    def _is_stop(tokens):
+        return tf.reduce_any(tf.equal(tokens[:, None], stop_tokens[None, :]), axis=-1)
+
+    def _generate(context, temperature, top_k, top_p, seed):
+        batch_size, context_length = tf.shape(context)[0], tf.shape(context)[1]
+        past = [tf.zeros([batch_size, 2, 0, shape[3], shape[4]], past_dtype) for shape in past_shapes]
+        outputs = model([
+            context,
+            tf.zeros([batch_size], tf.int32),
+            tf.ones([batch_size, context_length]),
+            tf.fill([batch_size, 1], context_length - 1),
+        ] + past)
+        past = list(outputs[1:])
+        next_token = _sample_graph(outputs[0][:, -1], temperature, top_k, top_p, tf.stack([seed, 0]))
+        tokens = tf.concat([next_token[:, None], tf.fill([batch_size, length - 1], end_token)], axis=1)
+
+        def _cond(i, next_token, finished, tokens, past):
+            return tf.logical_and(i < length, tf.logical_not(tf.reduce_all(finished)))
+
+        def _body(i, next_token, finished, tokens, past):
+            outputs = model([
+                next_token[:, None],
+                tf.fill([batch_size], context_length + i - 1),
+                tf.ones([batch_size, context_length + i]),
+                tf.zeros([batch_size, 1], tf.int32),
+            ] + past)
+            next_token = _sample_graph(outputs[0][:, -1], temperature, top_k, top_p, tf.stack([seed, i]))
+            next_token = tf.where(finished, tf.fill([batch_size], end_token), next_token)
+            tokens = tf.where(tf.equal(tf.range(length), i)[None, :], next_token[:, None], tokens)
+            return i + 1, next_token, tf.logical_or(finished, _is_stop(next_token)), tokens, list(outputs[1:])
+
+        _, _, _, tokens, _ = tf.while_loop(
+            _cond,
+            _body,
+            [tf.constant(1), next_token, _is_stop(next_token), tokens, past],
+            shape_invariants=[
+                tf.TensorShape([]),
+                tf.TensorShape([None]),
+                tf.TensorShape([None]),
+                tf.TensorShape([None, length]),
+                past_shapes,
+            ],
+        )
+        return tokens
+
+    signature = [
+        tf.TensorSpec([None, None], tf.int32),
+        tf.TensorSpec([], tf.float32),
+        tf.TensorSpec([], tf.int32),
+        tf.TensorSpec([], tf.float32),
+        tf.TensorSpec([], tf.int32),
+    ]
+    if tf.executing_eagerly():
+        run = tf.function(_generate, input_signature=signature)
+    else:
+        # Without eager execution the graph is built once on placeholders and run in the Keras session
+        placeholders = [tf.compat.v1.placeholder(spec.dtype, spec.shape) for spec in signature]
+        output = _generate(*placeholders)
+        session = tf.compat.v1.keras.backend.get_session()
+
+        def run(*values):
+            return session.run(output, feed_dict=dict(zip(placeholders, values)))
+
+    def generate(context, temperature=1.0, top_k=0, top_p=1.0, seed=None):
+        if seed is None:
+            seed = np.random.randint(2 ** 31 - 1)
+        return np.asarray(run(
+            np.asarray(context, dtype=np.int32),
+            np.float32(temperature),
+            np.int32(top_k),
+            np.float32(top_p),
+            np.int32(seed),
+        ))
+
+    return generate
@@ -1,5 +1,7 @@
 import math
+import functools
 
+import numpy as np
 import tensorflow as tf
 
 from tensorflow import keras
@@ -18,6 +20,46 @@ def attention_mask(nd, ns, dtype):
     return tf.cast(m, dtype)
 
 
+@functools.lru_cache(maxsize=64)
+def _static_causal_bias(nd, ns):
+    bias = np.where(np.arange(nd)[:, None] >= np.arange(ns) - ns + nd, 0.0, -1e9).astype(np.float32)
+    bias.setflags(write=False)
+    return bias
+
+
+def attention_bias(nd, ns, history_only=True, key_mask=None, segment_ids=None):
+    """Additive attention bias, 0 where a query attends to a key and -1e9 where it does not.
+
+    The queries are the last `nd` of the `ns` keys, so the causal part lines up with cached keys prepended to the new
+    ones. With static lengths the causal part is built once per pair of lengths and cached.
+
+    :param nd: Number of queries.
+    :param ns: Number of keys.
+    :param history_only: Whether every query only attends to its own and earlier positions.
+    :param key_mask: Optional tensor with shape `(batch_size, ns)`, 0 for the keys that are not attended to.
+    :param segment_ids: Optional tensor with shape `(batch_size, ns)` for packed sequences, queries only attend to the
+                        keys of their own segment.
+    :return: Float tensor with shape `(batch_size, 1, nd, ns)`, or `(1, 1, nd, ns)` without masks.
+    """
+    if not history_only:
+        bias = K.constant(0.0, shape=(1, 1, 1, 1))
+    elif isinstance(nd, int) and isinstance(ns, int):
+        bias = K.constant(_static_causal_bias(nd, ns))[None, None]
+    else:
+        bias = ((1.0 - attention_mask(nd, ns, K.floatx())) * -1e9)[None, None]
+    if key_mask is not None:
+        bias += (1.0 - K.cast(key_mask, K.floatx()))[:, None, None, :] * -1e9
+    if segment_ids is not None:
+        query_ids = segment_ids[:, ns - nd:]
+        other = K.cast(K.not_equal(query_ids[:, :, None], segment_ids[:, None, :]), K.floatx())
+        bias += other[:, None] * -1e9
+    return bias
+
+
+def _length(x, axis=1):
+    return x.shape[axis] if x.shape[axis] is not None else K.shape(x)[axis]
+
+
 def shape_list(x):
     """Deal with dynamic shape in tensorflow cleanly."""
     static = x.shape.as_list()
@@ -33,6 +75,14 @@ def gelu(x):
     return 0.5 * x * (1.0 + K.tanh(math.sqrt(2.0 / math.pi) * (x + 0.044715 * x * x * x)))
 
 
+def _dot_transposed(x, y):
+    """Same as `K.dot(x, K.transpose(y))`, without a transposed copy of `y`."""
+    outputs = tf.matmul(K.reshape(x, (-1, K.shape(x)[-1])), y, transpose_b=True)
+    outputs = K.reshape(outputs, K.concatenate([K.shape(x)[:-1], K.shape(y)[:1]]))
+    outputs.set_shape(x.shape[:-1].concatenate(y.shape[:1]))
+    return outputs
+
+
 class EmbeddingRet(keras.layers.Embedding):
     """Embedding layer with weights returned."""
 
@@ -60,7 +110,11 @@ class EmbeddingRet(keras.layers.Embedding):
 
 
 class EmbeddingSim(keras.layers.Layer):
-    """Calculate similarity between features and token embeddings with bias term."""
+    """Calculate similarity between features and token embeddings with bias term.
+
+    The product runs in the compute dtype of the layer, so half precision embeddings are not cast up to float32, and
+    only the logits are returned in float32.
+    """
 
     def __init__(self,
                  use_bias=True,
@@ -126,10 +180,10 @@ class EmbeddingSim(keras.layers.Layer):
         inputs, embeddings = inputs
         if self.stop_gradient:
             embeddings = K.stop_gradient(embeddings)
-        outputs = K.dot(inputs, K.transpose(embeddings))
+        outputs = _dot_transposed(inputs, embeddings)
         if self.use_bias:
             outputs = K.bias_add(outputs, self.bias)
-        return outputs
+        return K.cast(outputs, 'float32')
         # return keras.activations.softmax(outputs)
 
 
@@ -157,6 +211,10 @@ class PositionEmbedding(keras.layers.Layer):
 
         # Output shape
             3D tensor with shape: `(batch_size, sequence_length, feature_dim + output_dim)`.
+
+    In add and concat mode the input could also be a list `[features, offset]`, where `offset` is a 1D
+    integer tensor with shape `(batch_size,)` holding the position of the first token of every row.
+    This is used in incremental decoding, where only the new tokens are fed to the model.
     """
     MODE_EXPAND = 'expand'
     MODE_ADD = 'add'
@@ -227,6 +285,8 @@ class PositionEmbedding(keras.layers.Layer):
         super(PositionEmbedding, self).build(input_shape)
 
     def compute_mask(self, inputs, mask=None):
+        if isinstance(mask, list):
+            mask = mask[0]
         if self.mode == self.MODE_EXPAND:
             if self.mask_zero:
                 output_mask = K.not_equal(inputs, self.mask_zero)
@@ -237,6 +297,8 @@ class PositionEmbedding(keras.layers.Layer):
         return output_mask
 
     def compute_output_shape(self, input_shape):
+        if isinstance(input_shape, list):
+            input_shape = input_shape[0]
         if self.mode == self.MODE_EXPAND:
             return input_shape + (self.output_dim,)
         if self.mode == self.MODE_CONCAT:
@@ -244,6 +306,9 @@ class PositionEmbedding(keras.layers.Layer):
         return input_shape
 
     def call(self, inputs, **kwargs):
+        offset = None
+        if isinstance(inputs, list):
+            inputs, offset = inputs
         if self.mode == self.MODE_EXPAND:
             if K.dtype(inputs) != 'int32':
                 inputs = K.cast(inputs, 'int32')
@@ -256,10 +321,14 @@ class PositionEmbedding(keras.layers.Layer):
             batch_size, seq_len, output_dim = input_shape[0], input_shape[1], input_shape[2]
         else:
             batch_size, seq_len, output_dim = input_shape[0], input_shape[1], self.output_dim
-        pos_embeddings = K.tile(
-            K.expand_dims(self.embeddings[:seq_len, :self.output_dim], axis=0),
-            [batch_size, 1, 1],
-        )
+        if offset is None:
+            pos_embeddings = K.tile(
+                K.expand_dims(self.embeddings[:seq_len, :self.output_dim], axis=0),
+                [batch_size, 1, 1],
+            )
+        else:
+            positions = K.expand_dims(K.cast(offset, 'int32'), axis=-1) + K.expand_dims(K.arange(0, seq_len), axis=0)
+            pos_embeddings = K.gather(self.embeddings[:, :self.output_dim], positions)
         if self.mode == self.MODE_ADD:
             return inputs + pos_embeddings
         return K.concatenate([inputs, pos_embeddings], axis=-1)
@@ -362,6 +431,57 @@ class LayerNormalization(keras.layers.Layer):
         return outputs
 
 
+class AttentionBias(keras.layers.Layer):
+    """Additive attention bias built once per forward pass and shared by all the attention layers, see
+    `attention_bias`.
+
+    Takes the tokens, or `[tokens, key_mask]` where `key_mask` has shape `(batch_size, past_len + seq_len)` and covers
+    the cached keys too. With `packed` the segment ids of the keys come last, e.g. `[tokens, segment_ids]`.
+    """
+
+    def __init__(self,
+                 history_only=True,
+                 packed=False,
+                 **kwargs):
+        """Initialize the layer.
+
+        :param history_only: Whether every query only attends to its own and earlier positions.
+        :param packed: Whether the last input holds the segment ids of packed sequences.
+        :param kwargs: Arguments for parent class.
+        """
+        super(AttentionBias, self).__init__(**kwargs)
+        self.history_only = history_only
+        self.packed = packed
+
+    def get_config(self):
+        config = {
+            'history_only': self.history_only,
+            'packed': self.packed,
+        }
+        base_config = super(AttentionBias, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+    def compute_output_shape(self, input_shape):
+        if isinstance(input_shape, list):
+            input_shape = input_shape[0]
+        return (input_shape[0], 1, input_shape[1], None)
+
+    def compute_mask(self, inputs, mask=None):
+        return None
+
+    def call(self, inputs, **kwargs):
+        inputs = list(inputs) if isinstance(inputs, list) else [inputs]
+        tokens = inputs.pop(0)
+        segment_ids = inputs.pop() if self.packed else None
+        key_mask = inputs.pop() if inputs else None
+        nd = _length(tokens)
+        ns = nd
+        for keys in [key_mask, segment_ids]:
+            if keys is not None:
+                ns = _length(keys)
+        return attention_bias(nd, ns, history_only=self.history_only, key_mask=key_mask, segment_ids=segment_ids)
+
+
 class ScaledDotProductAttention(keras.layers.Layer):
     r"""The attention layer that takes three inputs representing queries, keys and values.
 
@@ -373,22 +493,29 @@ class ScaledDotProductAttention(keras.layers.Layer):
     def __init__(self,
                  return_attention=False,
                  history_only=False,
+                 block_size=None,
                  **kwargs):
         """Initialize the layer.
 
         :param return_attention: Whether to return attention weights.
         :param history_only: Whether to only use history data.
+        :param block_size: Number of keys per tile of the memory-efficient blockwise attention, None computes all the
+                           scores at once. The attention weights are never complete with it, so they can't be returned.
         :param kwargs: Arguments for parent class.
         """
+        if return_attention and block_size:
+            raise ValueError('The blockwise attention does not return attention weights')
         super(ScaledDotProductAttention, self).__init__(**kwargs)
         self.supports_masking = True
         self.return_attention = return_attention
         self.history_only = history_only
+        self.block_size = block_size
 
     def get_config(self):
         config = {
             'return_attention': self.return_attention,
             'history_only': self.history_only,
+            'block_size': self.block_size,
         }
         base_config = super(ScaledDotProductAttention, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
@@ -411,34 +538,139 @@ class ScaledDotProductAttention(keras.layers.Layer):
             return [mask, None]
         return mask
 
-    def call(self, inputs, mask=None, **kwargs):
+    def call(self, inputs, mask=None, bias=None, **kwargs):
+        """
+        :param bias: Optional bias from `AttentionBias` with shape `(batch_size, 1, query_len, key_len)`, which replaces
+                     `history_only` and the mask.
+        """
         if isinstance(inputs, list):
             query, key, value = inputs
         else:
             query = key = value = inputs
         if isinstance(mask, list):
             mask = mask[1]
+        if bias is None:
+            bias = attention_bias(_length(query), _length(key), history_only=self.history_only, key_mask=mask)
+        if self.block_size:
+            # A single head of the per-head layout
+            v = _blockwise_attention(query[:, :, None], key[:, :, None], value[:, :, None], bias, self.block_size)
+            return v[:, :, 0]
         feature_dim = K.shape(query)[-1]
-        e = K.batch_dot(query, key, axes=2) / K.sqrt(K.cast(feature_dim, dtype=K.floatx()))
-        e = K.exp(e - K.max(e, axis=-1, keepdims=True))
-        if self.history_only:
-            query_len, key_len = K.shape(query)[1], K.shape(key)[1]
-            indices = K.expand_dims(K.arange(0, key_len), axis=0)
-            upper = K.expand_dims(K.arange(0, query_len), axis=-1)
-            M = K.expand_dims(K.cast(indices <= upper, K.floatx()), axis=0)
-            e *= M
-        if mask is not None:
-            e *= K.cast(K.expand_dims(mask, axis=-2), K.floatx())
-        a = e / (K.sum(e, axis=-1, keepdims=True) + K.epsilon())
-        v = K.batch_dot(a, value)
+        # The softmax always runs in float32, even when the products are computed in lower precision
+        e = K.cast(K.batch_dot(query, key, axes=2), K.floatx()) / K.sqrt(K.cast(feature_dim, dtype=K.floatx()))
+        a = K.softmax(e + bias[:, 0])
+        v = K.batch_dot(K.cast(a, K.dtype(value)), value)
         if self.return_attention:
             return [v, a]
         return v
 
 
+def _attention(query, key, value, bias):
+    """Scaled dot-product attention of every head.
+
+    :param query: Tensor with shape `(batch_size, query_len, head_num, head_dim)`.
+    :param key: Tensor with shape `(batch_size, key_len, head_num, head_dim)`.
+    :param value: Tensor with the shape of `key`.
+    :param bias: Additive bias from `attention_bias` with shape `(batch_size, 1, query_len, key_len)`.
+    :return: Tensor with the shape of `query`.
+    """
+    feature_dim = K.shape(query)[-1]
+    # The softmax always runs in float32, even when the products are computed in lower precision
+    e = K.cast(tf.einsum('bqhd,bkhd->bhqk', query, key), K.floatx()) / K.sqrt(K.cast(feature_dim, dtype=K.floatx()))
+    # Masked keys are far below the maximum, so they get exactly 0 after the exponential
+    a = K.softmax(e + bias)
+    return tf.einsum('bhqk,bkhd->bqhd', K.cast(a, K.dtype(value)), value)
+
+
+def _blockwise_attention(query, key, value, bias, block_size):
+    """Same as `_attention`, but over tiles of `block_size` keys with an online softmax.
+
+    Only the scores of one tile exist at a time. The backward pass recomputes them from the inputs and the log-sum-exp
+    of every query, instead of keeping the probabilities of every layer around, so the extra memory grows with the
+    sequence length instead of its square.
+
+    See: https://arxiv.org/pdf/2205.14135.pdf
+    """
+    scale = 1.0 / K.sqrt(K.cast(K.shape(query)[-1], K.floatx()))
+    num_blocks = (K.shape(key)[1] + block_size - 1) // block_size
+
+    def tile(x, i):
+        return x[:, i * block_size:(i + 1) * block_size]
+
+    def scores(q, k, b, i):
+        # The bias could also be broadcast along the keys
+        b = b if b.shape[-1] == 1 else b[..., i * block_size:(i + 1) * block_size]
+        return K.cast(tf.einsum('bqhd,bkhd->bhqk', q, tile(k, i)), K.floatx()) * scale + b
+
+    def heads_first(x):
+        return tf.transpose(x, [0, 2, 1, 3])
+
+    @tf.custom_gradient
+    def blockwise(q, k, v, b):
+        batch_size, query_len, head_num = K.shape(q)[0], K.shape(q)[1], K.shape(q)[2]
+
+        def step(i, m, l, o):
+            e = scores(q, k, b, i)
+            m_new = K.maximum(m, K.max(e, axis=-1, keepdims=True))
+            p = K.exp(e - m_new)
+            correction = K.exp(m - m_new)
+            l = l * correction + K.sum(p, axis=-1, keepdims=True)
+            o = o * heads_first(correction) + K.cast(
+                tf.einsum('bhqk,bkhd->bqhd', K.cast(p, v.dtype), tile(v, i)), K.floatx())
+            return i + 1, m_new, l, o
+
+        _, m, l, o = tf.while_loop(
+            lambda i, *_: i < num_blocks,
+            step,
+            [
+                tf.constant(0),
+                tf.fill([batch_size, head_num, query_len, 1], -float('inf')),
+                tf.zeros([batch_size, head_num, query_len, 1]),
+                tf.zeros([batch_size, query_len, head_num, K.shape(v)[-1]]),
+            ],
+        )
+        output = o / heads_first(l)
+        log_sum_exp = m + K.log(l)
+
+        def grad(d_output):
+            d_output = K.cast(d_output, K.floatx())
+            d_sum = heads_first(K.sum(d_output * output, axis=-1, keepdims=True))
+
+            def grad_step(i, d_q, d_k, d_v):
+                p = K.exp(scores(q, k, b, i) - log_sum_exp)
+                d_p = tf.einsum('bqhd,bkhd->bhqk', d_output, K.cast(tile(v, i), K.floatx()))
+                d_e = p * (d_p - d_sum) * scale
+                d_q += tf.einsum('bhqk,bkhd->bqhd', d_e, K.cast(tile(k, i), K.floatx()))
+                # Tiles are stacked along the first axis, so the keys go first
+                d_k = d_k.write(i, tf.einsum('bhqk,bqhd->kbhd', d_e, K.cast(q, K.floatx())))
+                d_v = d_v.write(i, tf.einsum('bhqk,bqhd->kbhd', p, d_output))
+                return i + 1, d_q, d_k, d_v
+
+            _, d_q, d_k, d_v = tf.while_loop(
+                lambda i, *_: i < num_blocks,
+                grad_step,
+                [
+                    tf.constant(0),
+                    tf.zeros(K.shape(q)),
+                    tf.TensorArray(K.floatx(), size=num_blocks, infer_shape=False),
+                    tf.TensorArray(K.floatx(), size=num_blocks, infer_shape=False),
+                ],
+            )
+            d_k = tf.transpose(d_k.concat(), [1, 0, 2, 3])
+            d_v = tf.transpose(d_v.concat(), [1, 0, 2, 3])
+            return K.cast(d_q, q.dtype), K.cast(d_k, k.dtype), K.cast(d_v, v.dtype), tf.zeros_like(b)
+
+        return K.cast(output, value.dtype), grad
+
+    return blockwise(query, key, value, bias)
+
+
 class MultiHeadAttention(keras.layers.Layer):
     """Multi-head attention layer.
 
+    The queries, keys and values come out of one fused projection `Wqkv`, the same layout as `c_attn` in the GPT-2
+    checkpoints, and the heads are kept in a `(batch_size, seq_len, head_num, head_dim)` layout throughout.
+
     See: https://arxiv.org/pdf/1706.03762.pdf
     """
 
@@ -453,6 +685,8 @@ class MultiHeadAttention(keras.layers.Layer):
                  kernel_constraint=None,
                  bias_constraint=None,
                  history_only=False,
+                 use_past=False,
+                 block_size=None,
                  **kwargs):
         """Initialize the layer.
 
@@ -466,6 +700,15 @@ class MultiHeadAttention(keras.layers.Layer):
         :param kernel_constraint: Constraints for linear mappings.
         :param bias_constraint: Constraints for linear mappings.
         :param history_only: Whether to only use history in attention layer.
+        :param use_past: Whether the layer takes `[inputs, past]` and returns `[outputs, present]`, where `past` is the
+                         cached keys and values of the previous positions with shape
+                         `(batch_size, 2, past_len, head_num, head_dim)` and `present` is `past` extended by the inputs.
+                         The inputs could also be `[inputs, past, key_mask]`, where `key_mask` has the shape
+                         `(batch_size, past_len + seq_len)` and is 0 for the keys that should not be attended to,
+                         e.g. the padding of rows with a shorter history.
+                         All of them are replaced by the `bias` argument of `call`, see `AttentionBias`.
+        :param block_size: Number of keys per tile of the memory-efficient blockwise attention, None computes all the
+                           scores at once.
         """
         self.supports_masking = True
         self.head_num = head_num
@@ -478,9 +721,11 @@ class MultiHeadAttention(keras.layers.Layer):
         self.kernel_constraint = keras.constraints.get(kernel_constraint)
         self.bias_constraint = keras.constraints.get(bias_constraint)
         self.history_only = history_only
+        self.use_past = use_past
+        self.block_size = block_size
 
-        self.Wq, self.Wk, self.Wv, self.Wo = None, None, None, None
-        self.bq, self.bk, self.bv, self.bo = None, None, None, None
+        self.Wqkv, self.Wo = None, None
+        self.bqkv, self.bo = None, None
         super(MultiHeadAttention, self).__init__(**kwargs)
 
     def get_config(self):
@@ -495,22 +740,33 @@ class MultiHeadAttention(keras.layers.Layer):
             'kernel_constraint': keras.constraints.serialize(self.kernel_constraint),
             'bias_constraint': keras.constraints.serialize(self.bias_constraint),
             'history_only': self.history_only,
+            'use_past': self.use_past,
+            'block_size': self.block_size,
         }
         base_config = super(MultiHeadAttention, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
     def compute_output_shape(self, input_shape):
+        if self.use_past:
+            input_shape, past_shape = input_shape[:2]
+            return [input_shape, past_shape[:2] + (None,) + past_shape[3:]]
         if isinstance(input_shape, list):
             q, k, v = input_shape
             return q[:-1] + (v[-1],)
         return input_shape
 
     def compute_mask(self, inputs, input_mask=None):
+        if self.use_past:
+            if isinstance(input_mask, list):
+                input_mask = input_mask[0]
+            return [input_mask, None]
         if isinstance(input_mask, list):
             return input_mask[0]
         return input_mask
 
     def build(self, input_shape):
+        if self.use_past:
+            input_shape = input_shape[0]
         if isinstance(input_shape, list):
             q, k, v = input_shape
         else:
@@ -518,143 +774,93 @@ class MultiHeadAttention(keras.layers.Layer):
         feature_dim = int(v[-1])
         if feature_dim % self.head_num != 0:
             raise IndexError('Invalid head number %d with the given input dim %d' % (self.head_num, feature_dim))
-        self.Wq = self.add_weight(
-            shape=(int(q[-1]), feature_dim),
-            initializer=self.kernel_initializer,
-            regularizer=self.kernel_regularizer,
-            constraint=self.kernel_constraint,
-            name='%s_Wq' % self.name,
-        )
-        if self.use_bias:
-            self.bq = self.add_weight(
-                shape=(feature_dim,),
-                initializer=self.bias_initializer,
-                regularizer=self.bias_regularizer,
-                constraint=self.bias_constraint,
-                name='%s_bq' % self.name,
-            )
-        self.Wk = self.add_weight(
-            shape=(int(k[-1]), feature_dim),
-            initializer=self.kernel_initializer,
-            regularizer=self.kernel_regularizer,
-            constraint=self.kernel_constraint,
-            name='%s_Wk' % self.name,
-        )
+        if not int(q[-1]) == int(k[-1]) == feature_dim:
+            raise IndexError('The fused projection needs queries, keys and values of the same dim')
+        self.Wqkv = self._add_kernel((feature_dim, 3 * feature_dim), 'Wqkv')
         if self.use_bias:
-            self.bk = self.add_weight(
-                shape=(feature_dim,),
+            self.bqkv = self.add_weight(
+                shape=(3 * feature_dim,),
                 initializer=self.bias_initializer,
                 regularizer=self.bias_regularizer,
                 constraint=self.bias_constraint,
-                name='%s_bk' % self.name,
+                name='%s_bqkv' % self.name,
             )
-        self.Wv = self.add_weight(
-            shape=(int(v[-1]), feature_dim),
-            initializer=self.kernel_initializer,
-            regularizer=self.kernel_regularizer,
-            constraint=self.kernel_constraint,
-            name='%s_Wv' % self.name,
-        )
+        self.Wo = self._add_kernel((feature_dim, feature_dim), 'Wo')
         if self.use_bias:
-            self.bv = self.add_weight(
+            self.bo = self.add_weight(
                 shape=(feature_dim,),
                 initializer=self.bias_initializer,
                 regularizer=self.bias_regularizer,
                 constraint=self.bias_constraint,
-                name='%s_bv' % self.name,
+                name='%s_bo' % self.name,
             )
-        self.Wo = self.add_weight(
-            shape=(feature_dim, feature_dim),
+        super(MultiHeadAttention, self).build(input_shape)
+
+    def _add_kernel(self, shape, name):
+        return self.add_weight(
+            shape=shape,
             initializer=self.kernel_initializer,
             regularizer=self.kernel_regularizer,
             constraint=self.kernel_constraint,
-            name='%s_Wo' % self.name,
+            name='%s_%s' % (self.name, name),
         )
-        if self.use_bias:
-            self.bo = self.add_weight(
-                shape=(feature_dim,),
-                initializer=self.bias_initializer,
-                regularizer=self.bias_regularizer,
-                constraint=self.bias_constraint,
-                name='%s_bo' % self.name,
-            )
-        super(MultiHeadAttention, self).build(input_shape)
 
-    @staticmethod
-    def _reshape_to_batches(x, head_num):
-        input_shape = K.shape(x)
-        batch_size, seq_len, feature_dim = input_shape[0], input_shape[1], input_shape[2]
-        head_dim = feature_dim // head_num
-        x = K.reshape(x, (batch_size, seq_len, head_num, head_dim))
-        x = K.permute_dimensions(x, [0, 2, 1, 3])
-        return K.reshape(x, (batch_size * head_num, seq_len, head_dim))
-
-    @staticmethod
-    def _reshape_from_batches(x, head_num):
-        input_shape = K.shape(x)
-        batch_size, seq_len, feature_dim = input_shape[0], input_shape[1], input_shape[2]
-        x = K.reshape(x, (batch_size // head_num, head_num, seq_len, feature_dim))
-        x = K.permute_dimensions(x, [0, 2, 1, 3])
-        return K.reshape(x, (batch_size // head_num, seq_len, feature_dim * head_num))
-
-    @staticmethod
-    def _reshape_mask(mask, head_num):
-        if mask is None:
-            return mask
-        seq_len = K.shape(mask)[1]
-        mask = K.expand_dims(mask, axis=1)
-        mask = K.tile(mask, [1, head_num, 1, 1])
-        return K.reshape(mask, (-1, seq_len))
+    def _dot(self, x, name):
+        return K.dot(x, getattr(self, name))
+
+    def _project(self, x):
+        """Queries, keys and values of `x` with shape `(batch_size, seq_len, 3, head_num, head_dim)`."""
+        qkv = self._dot(x, 'Wqkv')
+        if self.use_bias:
+            qkv += self.bqkv
+        if self.activation is not None:
+            qkv = self.activation(qkv)
+        feature_dim = K.int_shape(x)[-1]
+        return K.reshape(qkv, (K.shape(x)[0], K.shape(x)[1], 3, self.head_num, feature_dim // self.head_num))
 
-    def call(self, inputs, mask=None):
+    def call(self, inputs, mask=None, bias=None):
+        """
+        :param bias: Optional bias from `AttentionBias` with shape `(batch_size, 1, query_len, key_len)`, built once
+                     for all the layers. It replaces `history_only`, the mask and `key_mask`.
+        """
+        past = key_mask = None
+        if self.use_past:
+            if len(inputs) == 3:
+                inputs, past, key_mask = inputs
+            else:
+                inputs, past = inputs
+            if isinstance(mask, list):
+                mask = mask[0]
         if isinstance(inputs, list):
-            q, k, v = inputs
+            # Different inputs each take their part of the fused projection
+            q, k, v = [self._project(x)[:, :, i] for i, x in enumerate(inputs)]
+            x = inputs[0]
         else:
-            q = k = v = inputs
+            qkv = self._project(inputs)
+            q, k, v = qkv[:, :, 0], qkv[:, :, 1], qkv[:, :, 2]
+            x = inputs
         if isinstance(mask, list):
-            q_mask, k_mask, v_mask = mask
+            mask = mask[1]
+        if past is not None:
+            # The mask only covers the new positions, the cached ones are masked by `key_mask`.
+            mask = key_mask
+            k = K.concatenate([past[:, 0], k], axis=1)
+            v = K.concatenate([past[:, 1], v], axis=1)
+            present = K.stack([k, v], axis=1)
+        if bias is None:
+            bias = attention_bias(_length(q), _length(k), history_only=self.history_only, key_mask=mask)
+        if self.block_size:
+            y = _blockwise_attention(q, k, v, bias, self.block_size)
         else:
-            q_mask = k_mask = v_mask = mask
-
-        q = K.dot(q, self.Wq)
-        k = K.dot(k, self.Wk)
-        v = K.dot(v, self.Wv)
-        if self.use_bias:
-            q += self.bq
-            k += self.bk
-            v += self.bv
-        if self.activation is not None:
-            q = self.activation(q)
-            k = self.activation(k)
-            v = self.activation(v)
-        y = ScaledDotProductAttention(
-            history_only=self.history_only,
-            name='%s-Attention' % self.name,
-        )(
-            inputs=[
-                self._reshape_to_batches(q, self.head_num),
-                self._reshape_to_batches(k, self.head_num),
-                self._reshape_to_batches(v, self.head_num),
-            ],
-            mask=[
-                self._reshape_mask(q_mask, self.head_num),
-                self._reshape_mask(k_mask, self.head_num),
-                self._reshape_mask(v_mask, self.head_num),
-            ],
-        )
-        y = self._reshape_from_batches(y, self.head_num)
-        y = K.dot(y, self.Wo)
+            y = _attention(q, k, v, bias)
+        y = K.reshape(y, (K.shape(x)[0], K.shape(x)[1], K.int_shape(x)[-1]))
+        y = self._dot(y, 'Wo')
         if self.use_bias:
             y += self.bo
         if self.activation is not None:
             y = self.activation(y)
-
-        # Add shape information to tensor when using `tf.keras`
-        input_shape = [K.int_shape(q), K.int_shape(k), K.int_shape(v)]
-        output_shape = self.compute_output_shape(input_shape)
-        if output_shape[1] is not None:
-            output_shape = (-1,) + output_shape[1:]
-            y = K.reshape(y, output_shape)
+        if past is not None:
+            return [y, present]
         return y
 
 
@@ -662,7 +868,12 @@ def attention_builder(name,
                       head_num,
                       activation,
                       history_only,
-                      trainable=True):
+                      trainable=True,
+                      use_past=False,
+                      dtype=None,
+                      quantized=False,
+                      bias=None,
+                      block_size=None):
     """Get multi-head self-attention builder.
 
     :param name: Prefix of names for internal layers.
@@ -670,16 +881,26 @@ def attention_builder(name,
     :param activation: Activation for multi-head self-attention.
     :param history_only: Only use history data.
     :param trainable: Whether the layer is trainable.
+    :param use_past: Whether the layer takes and returns cached keys and values.
+    :param dtype: Dtype of the weights and the products, defaults to float32.
+    :param quantized: Whether the kernels are stored in int8.
+    :param bias: Optional attention bias shared with the other layers, see `AttentionBias`.
+    :param block_size: Number of keys per tile of the blockwise attention, None computes all the scores at once.
     :return:
     """
+    layer_class = QuantizedMultiHeadAttention if quantized else MultiHeadAttention
+
     def _attention_builder(x):
-        return MultiHeadAttention(
+        return layer_class(
             head_num=head_num,
             activation=activation,
             history_only=history_only,
             trainable=trainable,
+            use_past=use_past,
+            block_size=block_size,
+            dtype=dtype,
             name=name,
-        )(x)
+        )(x, bias=bias)
     return _attention_builder
 
 
@@ -759,13 +980,7 @@ class FeedForward(keras.layers.Layer):
 
     def build(self, input_shape):
         feature_dim = int(input_shape[-1])
-        self.W1 = self.add_weight(
-            shape=(feature_dim, self.units),
-            initializer=self.kernel_initializer,
-            regularizer=self.kernel_regularizer,
-            constraint=self.kernel_constraint,
-            name='{}_W1'.format(self.name),
-        )
+        self.W1 = self._add_kernel((feature_dim, self.units), 'W1')
         if self.use_bias:
             self.b1 = self.add_weight(
                 shape=(self.units,),
@@ -774,13 +989,7 @@ class FeedForward(keras.layers.Layer):
                 constraint=self.bias_constraint,
                 name='{}_b1'.format(self.name),
             )
-        self.W2 = self.add_weight(
-            shape=(self.units, feature_dim),
-            initializer=self.kernel_initializer,
-            regularizer=self.kernel_regularizer,
-            constraint=self.kernel_constraint,
-            name='{}_W2'.format(self.name),
-        )
+        self.W2 = self._add_kernel((self.units, feature_dim), 'W2')
         if self.use_bias:
             self.b2 = self.add_weight(
                 shape=(feature_dim,),
@@ -791,8 +1000,20 @@ class FeedForward(keras.layers.Layer):
             )
         super(FeedForward, self).build(input_shape)
 
+    def _add_kernel(self, shape, name):
+        return self.add_weight(
+            shape=shape,
+            initializer=self.kernel_initializer,
+            regularizer=self.kernel_regularizer,
+            constraint=self.kernel_constraint,
+            name='{}_{}'.format(self.name, name),
+        )
+
+    def _dot(self, x, name):
+        return K.dot(x, getattr(self, name))
+
     def call(self, x, mask=None, training=None):
-        h = K.dot(x, self.W1)
+        h = self._dot(x, 'W1')
         if self.use_bias:
             h = K.bias_add(h, self.b1)
         if self.activation is not None:
@@ -801,25 +1022,145 @@ class FeedForward(keras.layers.Layer):
             def dropped_inputs():
                 return K.dropout(h, self.dropout_rate, K.shape(h))
             h = K.in_train_phase(dropped_inputs, h, training=training)
-        y = K.dot(h, self.W2)
+        y = self._dot(h, 'W2')
         if self.use_bias:
             y = K.bias_add(y, self.b2)
         return y
 
 
-def _wrap_layer(name, input_layer, build_func, trainable=True):
+class Recompute(keras.layers.Layer):
+    """Calls a model with gradient checkpointing.
+
+    Only the inputs of the model are kept for the backward pass, its intermediate activations are computed again from
+    them. The wrapped model is shared, not copied, and the layer can not be serialized, so save the wrapped model or the
+    model it was cut from instead.
+    """
+
+    def __init__(self, model, **kwargs):
+        """Initialize the layer.
+
+        :param model: Model with one or more inputs and a single output.
+        :param kwargs: Arguments for parent class.
+        """
+        super(Recompute, self).__init__(**kwargs)
+        self.model = model
+
+    def compute_output_shape(self, input_shape):
+        return self.model.compute_output_shape(input_shape)
+
+    def call(self, inputs, **kwargs):
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        return tf.recompute_grad(lambda *x: self.model(list(x)))(*inputs)
+
+
+class QuantizedEmbeddingRet(EmbeddingRet):
+    """`EmbeddingRet` with int8 embeddings and one scale per token, returns `[outputs, embeddings, scale]`."""
+
+    def build(self, input_shape):
+        self.embeddings = self.add_weight(
+            shape=(self.input_dim, self.output_dim),
+            initializer='zeros',
+            dtype='int8',
+            trainable=False,
+            name='embeddings',
+        )
+        self.scale = self.add_weight(
+            shape=(self.input_dim,),
+            initializer='ones',
+            trainable=False,
+            name='scale',
+        )
+        self.built = True
+
+    def compute_output_shape(self, input_shape):
+        return super(QuantizedEmbeddingRet, self).compute_output_shape(input_shape) + [(self.input_dim,)]
+
+    def compute_mask(self, inputs, mask=None):
+        return super(QuantizedEmbeddingRet, self).compute_mask(inputs, mask) + [None]
+
+    def call(self, inputs):
+        if K.dtype(inputs) != 'int32':
+            inputs = K.cast(inputs, 'int32')
+        outputs = K.cast(K.gather(self.embeddings, inputs), self.scale.dtype)
+        outputs *= K.expand_dims(K.gather(self.scale, inputs), axis=-1)
+        return [
+            outputs,
+            tf.identity(self.embeddings),
+            tf.identity(self.scale),
+        ]
+
+
+class QuantizedEmbeddingSim(EmbeddingSim):
+    """`EmbeddingSim` that takes `[features, embeddings, scale]` from `QuantizedEmbeddingRet`."""
+
+    def build(self, input_shape):
+        super(QuantizedEmbeddingSim, self).build(input_shape[:2])
+
+    def compute_output_shape(self, input_shape):
+        return super(QuantizedEmbeddingSim, self).compute_output_shape(input_shape[:2])
+
+    def call(self, inputs, mask=None, **kwargs):
+        inputs, embeddings, scale = inputs
+        # Scaling the products of a token is the same as scaling its embedding
+        outputs = _dot_transposed(inputs, K.cast(embeddings, K.dtype(inputs))) * K.cast(scale, K.dtype(inputs))
+        if self.use_bias:
+            outputs = K.bias_add(outputs, self.bias)
+        return K.cast(outputs, 'float32')
+
+
+class _QuantizedKernels(object):
+    """Int8 kernels with one scale per output channel, dequantized inside the matrix product."""
+
+    def _add_kernel(self, shape, name):
+        kernel = self.add_weight(
+            shape=shape,
+            initializer='zeros',
+            dtype='int8',
+            trainable=False,
+            name='%s_%s' % (self.name, name),
+        )
+        setattr(self, '%s_scale' % name, self.add_weight(
+            shape=shape[-1:],
+            initializer='ones',
+            trainable=False,
+            name='%s_%s_scale' % (self.name, name),
+        ))
+        return kernel
+
+    def _dot(self, x, name):
+        kernel, scale = getattr(self, name), getattr(self, '%s_scale' % name)
+        return K.dot(x, K.cast(kernel, K.dtype(x))) * K.cast(scale, K.dtype(x))
+
+
+class QuantizedMultiHeadAttention(_QuantizedKernels, MultiHeadAttention):
+    """`MultiHeadAttention` with int8 kernels, see `quantization.quantize_model`."""
+
+
+class QuantizedFeedForward(_QuantizedKernels, FeedForward):
+    """`FeedForward` with int8 kernels, see `quantization.quantize_model`."""
+
+
+def _wrap_layer(name, input_layer, build_func, trainable=True, past=None, key_mask=None):
     """Wrap layers with normalization and residual.
 
     :param name: Prefix of names for internal layers.
     :param input_layer: Input layer.
     :param build_func: A callable that takes the input tensor and generates the output tensor.
     :param trainable: Whether the layers are trainable.
-    :return: Output layer.
+    :param past: Cached keys and values passed along with the normalized input to `build_func`.
+    :param key_mask: Optional mask of the keys passed after `past`.
+    :return: Output layer, and the updated cache if `past` is given.
     """
     normal_layer = LayerNormalization(
         trainable=trainable,
         name='%s-Norm' % name,
     )(input_layer)
+    if past is not None:
+        if key_mask is not None:
+            build_output, present = build_func([normal_layer, past, key_mask])
+        else:
+            build_output, present = build_func([normal_layer, past])
+        return keras.layers.Add(name='%s-Add' % name)([input_layer, build_output]), present
     build_output = build_func(normal_layer)
     return keras.layers.Add(name='%s-Add' % name)([input_layer, build_output])
 
@@ -827,20 +1168,27 @@ def _wrap_layer(name, input_layer, build_func, trainable=True):
 def feed_forward_builder(name,
                          hidden_dim,
                          activation,
-                         trainable=True):
+                         trainable=True,
+                         dtype=None,
+                         quantized=False):
     """Get position-wise feed-forward layer builder.
 
     :param name: Prefix of names for internal layers.
     :param hidden_dim: Hidden dimension of feed forward layer.
     :param activation: Activation for feed-forward layer.
     :param trainable: Whether the layer is trainable.
+    :param dtype: Dtype of the weights and the products, defaults to float32.
+    :param quantized: Whether the kernels are stored in int8.
     :return:
     """
+    layer_class = QuantizedFeedForward if quantized else FeedForward
+
     def _feed_forward_builder(x):
-        return FeedForward(
+        return layer_class(
             units=hidden_dim,
             activation=activation,
             trainable=trainable,
+            dtype=dtype,
             name=name,
         )(x)
     return _feed_forward_builder
@@ -852,7 +1200,13 @@ def _get_encoder_component(name,
                            hidden_dim,
                            attention_activation=None,
                            feed_forward_activation='relu',
-                           trainable=True):
+                           trainable=True,
+                           past=None,
+                           key_mask=None,
+                           dtype=None,
+                           quantized=False,
+                           bias=None,
+                           block_size=None):
     """Multi-head self-attention and feed-forward layer.
 
     :param name: Prefix of names for internal layers.
@@ -862,7 +1216,16 @@ def _get_encoder_component(name,
     :param attention_activation: Activation for multi-head self-attention.
     :param feed_forward_activation: Activation for feed-forward layer.
     :param trainable: Whether the layers are trainable.
-    :return: Output layer.
+    :param past: Optional cached keys and values of the attention layer,
+                 with shape `(batch_size, 2, past_len, head_num, head_dim)`.
+    :param key_mask: Optional mask of the cached and new keys, with shape `(batch_size, past_len + seq_len)`.
+    :param dtype: Dtype of the attention and feed-forward weights and products, e.g. 'bfloat16' for inference.
+                  The normalization and the residual connections always stay in float32.
+    :param quantized: Whether the attention and feed-forward kernels are stored in int8.
+    :param bias: Optional attention bias shared by all the layers, see `AttentionBias`. It already holds `key_mask`.
+    :param block_size: Number of keys per tile of the memory-efficient blockwise attention, e.g. for training on long
+                       sequences. None computes all the scores at once.
+    :return: Output layer, and the updated cache if `past` is given.
     """
     attention_name = '%s-MultiHeadAtt' % name
     feed_forward_name = '%s-FeedForward' % name
@@ -875,9 +1238,18 @@ def _get_encoder_component(name,
             activation=attention_activation,
             history_only=True,
             trainable=trainable,
+            use_past=past is not None,
+            dtype=dtype,
+            quantized=quantized,
+            bias=bias,
+            block_size=block_size,
         ),
         trainable=trainable,
+        past=past,
+        key_mask=key_mask if bias is None else None,
     )
+    if past is not None:
+        attention_layer, present = attention_layer
     feed_forward_layer = _wrap_layer(
         name=feed_forward_name,
         input_layer=attention_layer,
@@ -886,7 +1258,11 @@ def _get_encoder_component(name,
             hidden_dim=hidden_dim,
             activation=feed_forward_activation,
             trainable=trainable,
+            dtype=dtype,
+            quantized=quantized,
         ),
         trainable=trainable,
     )
+    if past is not None:
+        return feed_forward_layer, present
     return feed_forward_layer
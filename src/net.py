@@ -1,8 +1,17 @@
+import time
+import argparse
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import h5py
+import numpy as np
 import tensorflow as tf
 from tensorflow import keras
+from tensorflow.keras import backend as K
 from src.layers import EmbeddingSim, EmbeddingRet, PositionEmbedding, LayerNormalization, _get_encoder_component, gelu
+from src.layers import MultiHeadAttention, AttentionBias, Recompute
+from src.layers import QuantizedEmbeddingSim, QuantizedEmbeddingRet
 
 
 def loss(labels, logits):
@@ -10,7 +19,34 @@ def loss(labels, logits):
     labels, logits[:, :-1, :], from_logits=True)
 
 
-def create_model(args):
+def create_model(args, past=False, precision='float32', quantized=False, block_size=None):
+    """Build the GPT-2 graph.
+
+    With `past` the model runs incrementally: it takes
+    `[tokens, offset, key_mask, logits_index, past_0, ..., past_{n_layer-1}]` and returns
+    `[logits, present_0, ..., present_{n_layer-1}]`, where `offset` is the position of the first token of every row,
+    `key_mask` marks the cached and new positions that hold real tokens (rows with a shorter history are padded on the
+    left), `logits_index` with shape `(batch_size, n)` picks the positions among the new tokens that are projected to
+    logits (usually only the last one while generating) and `past_i` / `present_i` are the cached keys and values of
+    layer `i` before / after the tokens.
+    The batch size of an incremental model is left open, since the number of rows in flight changes between steps.
+
+    `precision` ('float32', 'float16' or 'bfloat16') is the dtype of the token embeddings, the attention and
+    feed-forward weights and their products, of the vocabulary projection and of the cached keys and values. The layer
+    normalization, the softmax of the attention, the residual connections and the output logits always stay in
+    float32. The weights are stored in
+    `precision`, so they are cast once when they are loaded.
+    For training, `precision` can also be the mixed policy 'mixed_float16' or 'mixed_bfloat16': the weights of those
+    layers stay in float32 and are cast to half precision inside every product, so the optimizer updates the float32
+    weights.
+
+    With `quantized` the token embeddings and the attention and feed-forward kernels are int8 with one scale per output
+    channel, as written by quantize.py, and are dequantized to `precision` inside every matrix product.
+
+    With `block_size` the attention runs over tiles of that many keys with an online softmax, and recomputes the tiles
+    in the backward pass. It trades some speed for not keeping the `(seq_len, seq_len)` attention probabilities of
+    every layer for the backward pass.
+    """
 
     if not args.json_hparams:
         print('json_hparams must be provided.')
@@ -26,17 +62,45 @@ def create_model(args):
     n_head = hparams['n_head'] 
     n_layer = hparams['n_layer']
     
-    batch_size = args.batch_size
+    batch_size = None if past else args.batch_size
 
     input_layer = keras.layers.Input(
         batch_shape=(batch_size, None),
         name='Input',
     )
+    inputs = input_layer
 
-    embed_token, embeddings = EmbeddingRet(
+    if past:
+        offset_layer = keras.layers.Input(
+            batch_shape=(batch_size,),
+            dtype='int32',
+            name='Input-Offset',
+        )
+        key_mask_layer = keras.layers.Input(
+            batch_shape=(batch_size, None),
+            name='Input-Key-Mask',
+        )
+        logits_index_layer = keras.layers.Input(
+            batch_shape=(batch_size, None),
+            dtype='int32',
+            name='Input-Logits-Index',
+        )
+        past_layers = [
+            keras.layers.Input(
+                batch_shape=(batch_size, 2, None, n_head, n_embd // n_head),
+                dtype=keras.mixed_precision.Policy(precision).compute_dtype,
+                name='Input-Past-%d' % i,
+            )
+            for i in range(n_layer)
+        ]
+        inputs = [input_layer, offset_layer, key_mask_layer, logits_index_layer] + past_layers
+
+    embedding_class = QuantizedEmbeddingRet if quantized else EmbeddingRet
+    embed_token, *embeddings = embedding_class(
         input_dim=n_vocab,
         output_dim=n_embd,
         mask_zero=False,
+        dtype=precision,
         name='Embed-Token',
     )(input_layer)
 
@@ -45,9 +109,15 @@ def create_model(args):
         output_dim=n_embd,
         mode='add',
         name='Embed-Token-Pos',
-    )(embed_token)
+    )([embed_token, offset_layer] if past else embed_token)
+
+    # One causal and padding mask for all the layers
+    bias_layer = AttentionBias(
+        name='Attention-Bias',
+    )([input_layer, key_mask_layer] if past else input_layer)
 
     last_layer = embed_token_pos
+    presents = []
     for i in range(n_layer):
         last_layer = _get_encoder_component(
             name='Encode-%d' % i,
@@ -56,24 +126,89 @@ def create_model(args):
             hidden_dim=n_embd * 4,
             attention_activation=None,
             feed_forward_activation=gelu,
+            past=past_layers[i] if past else None,
+            dtype=precision,
+            quantized=quantized,
+            bias=bias_layer,
+            block_size=block_size,
         )
+        if past:
+            last_layer, present = last_layer
+            presents.append(present)
+
+    if past:
+        # The vocabulary projection is most of the work of a decoding step, so only the positions asked for get it
+        last_layer = keras.layers.Lambda(
+            lambda x: tf.gather(x[0], x[1], batch_dims=1),
+            name='Logits-Positions',
+        )([last_layer, logits_index_layer])
 
     norm_layer = LayerNormalization(
         name='Norm',
     )(last_layer)
 
-    output_layer = EmbeddingSim(
+    output_class = QuantizedEmbeddingSim if quantized else EmbeddingSim
+    output_layer = output_class(
         use_bias=False,
+        dtype=precision,
         name='Output',
-    )([norm_layer, embeddings])
+    )([norm_layer] + embeddings)
 
+    if past:
+        output_layer = [output_layer] + presents
 
-    model = keras.models.Model(inputs=input_layer, outputs=output_layer)
+    model = keras.models.Model(inputs=inputs, outputs=output_layer)
 
     return model
 
 
-def load_weights(model, args):
+def load_checkpoint_model(model_dir, past=True, precision='float32'):
+    """Frozen model of a released checkpoint folder holding hparams.json and model.ckpt, e.g. a smaller draft model."""
+    args = argparse.Namespace(
+        json_hparams=model_dir + "hparams.json",
+        model_ckpt=model_dir + "model.ckpt",
+        batch_size=None,
+    )
+    model = create_model(args, past=past, precision=precision)
+    model = load_weights(model, args)
+    model.trainable = False
+    return model
+
+
+def _assign(values):
+    """`K.batch_set_value`, without running the random initializers of the assigned variables first in graph mode."""
+    if not tf.executing_eagerly():
+        for variable, _ in values:
+            # Keras runs the initializer of every variable it has not marked yet before the first session run
+            variable._keras_initialized = True
+    K.batch_set_value(values)
+
+
+def _checkpoint_names(n_layer):
+    """Layer names of the model and the checkpoint variables of their weights, in the order of the layer weights."""
+    names = [
+        ('Embed-Token', ['model/wte']),
+        ('Embed-Token-Pos', ['model/wpe']),
+    ]
+    for i in range(n_layer):
+        names += [
+            ('Encode-%d-MultiHeadAtt-Norm' % i, ['model/h%d/ln_1/g' % i, 'model/h%d/ln_1/b' % i]),
+            ('Encode-%d-MultiHeadAtt' % i, ['model/h%d/attn/c_attn/w' % i, 'model/h%d/attn/c_attn/b' % i,
+                                             'model/h%d/attn/c_proj/w' % i, 'model/h%d/attn/c_proj/b' % i]),
+            ('Encode-%d-FeedForward-Norm' % i, ['model/h%d/ln_2/g' % i, 'model/h%d/ln_2/b' % i]),
+            ('Encode-%d-FeedForward' % i, ['model/h%d/mlp/c_fc/w' % i, 'model/h%d/mlp/c_fc/b' % i,
+                                           'model/h%d/mlp/c_proj/w' % i, 'model/h%d/mlp/c_proj/b' % i]),
+        ]
+    names.append(('Norm', ['model/ln_f/g', 'model/ln_f/b']))
+    return names
+
+
+def load_weights(model, args, workers=4):
+    """Load the weights of a released GPT-2 checkpoint `args.model_ckpt` into a model from `create_model`.
+
+    The checkpoint is opened once and every tensor is read in one pass, by `workers` threads with one reader each,
+    then all the weights are assigned at once.
+    """
 
     if not args.json_hparams:
         print('json_hparams must be provided.')
@@ -83,66 +218,267 @@ def load_weights(model, args):
     with open(args.json_hparams) as f:
         hparams = json.load(f)
 
-    n_vocab = hparams['n_vocab']
-    n_ctx = hparams['n_ctx']
-    n_embd = hparams['n_embd']
-    n_head = hparams['n_head'] 
     n_layer = hparams['n_layer']
+    names = _checkpoint_names(n_layer)
 
-    layer = model.get_layer(name='Embed-Token')
-    layer.set_weights([
-        tf.train.load_variable(args.model_ckpt, 'model/wte:0'),
-    ])
-    layer.trainable=False
+    start = time.time()
+    readers = threading.local()
 
-    layer = model.get_layer(name='Embed-Token-Pos')
-    layer.set_weights([
-        tf.train.load_variable(args.model_ckpt, 'model/wpe:0')[:, :],
-    ])
-    layer.trainable=False
+    def read(name):
+        if not hasattr(readers, 'reader'):
+            readers.reader = tf.train.load_checkpoint(args.model_ckpt)
+        value = readers.reader.get_tensor(name)
+        # The kernels are stored as 1x1 convolutions, with shape (1, input_dim, output_dim)
+        return value[0] if value.ndim == 3 else value
 
-    for i in range(n_layer):
-        model.get_layer(name='Encode-%d-MultiHeadAtt-Norm' % i).set_weights([
-            tf.train.load_variable(args.model_ckpt, 'model/h%d/ln_1/g:0' % i),
-            tf.train.load_variable(args.model_ckpt, 'model/h%d/ln_1/b:0' % i),
-        ])
-        kernel = tf.train.load_variable(args.model_ckpt, 'model/h%d/attn/c_attn/w:0' % i)[0]
-        bias = tf.train.load_variable(args.model_ckpt, 'model/h%d/attn/c_attn/b:0' % i)
-        model.get_layer(name='Encode-%d-MultiHeadAtt' % i).set_weights([
-            kernel[:, :n_embd],
-            bias[:n_embd],
-            kernel[:, n_embd:-n_embd],
-            bias[n_embd:-n_embd],
-            kernel[:, -n_embd:],
-            bias[-n_embd:],
-            tf.train.load_variable(args.model_ckpt, 'model/h%d/attn/c_proj/w:0' % i)[0],
-            tf.train.load_variable(args.model_ckpt, 'model/h%d/attn/c_proj/b:0' % i),
-        ])
-        model.get_layer(name='Encode-%d-FeedForward-Norm' % i).set_weights([
-            tf.train.load_variable(args.model_ckpt, 'model/h%d/ln_2/g:0' % i),
-            tf.train.load_variable(args.model_ckpt, 'model/h%d/ln_2/b:0' % i),
-        ])
-        model.get_layer(name='Encode-%d-FeedForward' % i).set_weights([
-            tf.train.load_variable(args.model_ckpt, 'model/h%d/mlp/c_fc/w:0' % i)[0],
-            tf.train.load_variable(args.model_ckpt, 'model/h%d/mlp/c_fc/b:0' % i),
-            tf.train.load_variable(args.model_ckpt, 'model/h%d/mlp/c_proj/w:0' % i)[0],
-            tf.train.load_variable(args.model_ckpt, 'model/h%d/mlp/c_proj/b:0' % i),
-        ])
-    layer = model.get_layer(name='Norm')
-    layer.set_weights([
-        tf.train.load_variable(args.model_ckpt, 'model/ln_f/g:0'),
-        tf.train.load_variable(args.model_ckpt, 'model/ln_f/b:0'),
-    ])
-    layer.trainable=False
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        tensors = list(executor.map(read, [name for _, variables in names for name in variables]))
+    read_time = time.time()
+
+    values = []
+    for layer_name, variables in names:
+        layer = model.get_layer(name=layer_name)
+        values += zip(layer.weights, tensors[:len(variables)])
+        tensors = tensors[len(variables):]
+    _assign(values)
+
+    for layer_name in ['Embed-Token', 'Embed-Token-Pos', 'Norm']:
+        model.get_layer(name=layer_name).trainable = False
+
+    print('loaded %s: read %.1f MB in %.2fs, assigned in %.2fs' % (
+        args.model_ckpt, sum(value.nbytes for _, value in values) / 2 ** 20, read_time - start, time.time() - read_time))
+
+    return model
+
+
+def _weight_suffix(layer_name, weight_name):
+    # 'Encode-0-MultiHeadAtt/Encode-0-MultiHeadAtt_Wqkv:0' -> 'Wqkv'
+    return weight_name.split('/')[-1].split(':')[0][len(layer_name) + 1:]
+
+
+def load_h5_weights(model, path):
+    """Load an .h5 file written by `model.save_weights` or `model.save` into a model, matching the layers by name.
+
+    Files written before the attention layers fused their projections hold separate `Wq`, `Wk` and `Wv` kernels and
+    biases (and their int8 scales), which are concatenated into `Wqkv` and `bqkv` on the way.
+    """
+
+    def decode(name):
+        return name.decode('utf8') if isinstance(name, bytes) else name
+
+    values = []
+    with h5py.File(path, 'r') as f:
+        group = f['model_weights'] if 'model_weights' in f else f
+        for layer in model.layers:
+            if not layer.weights or layer.name not in group:
+                continue
+            layer_group = group[layer.name]
+            names = [decode(name) for name in layer_group.attrs['weight_names']]
+            saved = [np.asarray(layer_group[name]) for name in names]
+            if isinstance(layer, MultiHeadAttention):
+                saved = dict((_weight_suffix(layer.name, name), value) for name, value in zip(names, saved))
+                for suffix in list(saved):
+                    if suffix.startswith(('Wq', 'bq')) and 'qkv' not in suffix:
+                        fused = suffix[0] + 'qkv' + suffix[2:]
+                        saved[fused] = np.concatenate([saved[suffix[0] + c + suffix[2:]] for c in 'qkv'], axis=-1)
+                saved = [saved.get(_weight_suffix(layer.name, weight.name)) for weight in layer.weights]
+            if len(saved) != len(layer.weights) or any(value is None for value in saved):
+                raise ValueError('Layer %s expects %d weights, %s does not hold them' % (
+                    layer.name, len(layer.weights), path))
+            for weight, value in zip(layer.weights, saved):
+                if tuple(weight.shape) != value.shape:
+                    raise ValueError('Weight %s has shape %s, %s holds %s' % (
+                        weight.name, tuple(weight.shape), path, value.shape))
+                values.append((weight, value))
+    _assign(values)
+
+    # Frozen like in `load_weights`, the saved trainable flags are not read back
+    for layer_name in ['Embed-Token', 'Embed-Token-Pos', 'Norm']:
+        model.get_layer(name=layer_name).trainable = False
 
     return model
 
 
+FLAT_MAGIC = b'GPT2FLAT'
+FLAT_ALIGNMENT = 64
+
+
+def _flat_name(layer, weight):
+    # 'Encode-0-MultiHeadAtt/Encode-0-MultiHeadAtt_Wqkv:0' -> 'Encode-0-MultiHeadAtt/Wqkv', 'Norm/gamma:0' -> 'Norm/gamma'
+    name = weight.name.split('/')[-1].split(':')[0]
+    if name.startswith(layer.name + '_'):
+        name = name[len(layer.name) + 1:]
+    return layer.name + '/' + name
+
+
+def _flat_align(offset):
+    return -(-offset // FLAT_ALIGNMENT) * FLAT_ALIGNMENT
+
+
+def _flat_weights(model):
+    return [(_flat_name(layer, weight), weight) for layer in model.layers for weight in layer.weights]
+
+
+def save_flat_weights(model, path, dtype=None):
+    """Write the weights of a model to `path` in the flat format read by `load_flat_weights`.
+
+    The file starts with `FLAT_MAGIC`, the length of a json header as a little-endian uint64 and the header, which
+    lists the name, dtype, shape and offset of every tensor. The tensors follow, from the first multiple of
+    `FLAT_ALIGNMENT` bytes after the header, with every offset aligned to `FLAT_ALIGNMENT` as well.
+    `dtype` ('float16' for instance) converts the floating point matrices, which hold nearly all the bytes. The biases,
+    norms and scales stay as they are, like the int8 weights of quantized models.
+    """
+
+    tensors = []
+    for (name, _), value in zip(_flat_weights(model), model.get_weights()):
+        if dtype and value.ndim > 1 and np.issubdtype(value.dtype, np.floating):
+            value = value.astype(dtype)
+        tensors.append((name, np.ascontiguousarray(value)))
+
+    entries, offset = [], 0
+    for name, value in tensors:
+        entries.append({'name': name, 'dtype': value.dtype.name, 'shape': list(value.shape), 'offset': offset})
+        offset = _flat_align(offset + value.nbytes)
+    header = json.dumps({'tensors': entries}).encode('utf8')
+    start = _flat_align(len(FLAT_MAGIC) + 8 + len(header))
+
+    with open(path, 'wb') as f:
+        f.write(FLAT_MAGIC)
+        f.write(np.array(len(header), dtype='<u8').tobytes())
+        f.write(header)
+        for entry, (_, value) in zip(entries, tensors):
+            f.write(b'\0' * (start + entry['offset'] - f.tell()))
+            f.write(value.tobytes())
+
+
+def load_flat_weights(model, path):
+    """Load a file written by `save_flat_weights` into a model with the same layers, matching the weights by name.
+
+    The file is memory mapped read-only, so the tensors are only read from the page cache, which is shared by every
+    process that loads the same file, and are copied once into the variables. Weights stored in another dtype than the
+    one of the model are converted on the way.
+    """
+
+    start = time.time()
+    with open(path, 'rb') as f:
+        if f.read(len(FLAT_MAGIC)) != FLAT_MAGIC:
+            raise ValueError('%s is not a flat weight file' % path)
+        length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(length).decode('utf8'))
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    data_start = _flat_align(len(FLAT_MAGIC) + 8 + length)
+    tensors = {}
+    for entry in header['tensors']:
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape']))
+        offset = data_start + entry['offset']
+        tensors[entry['name']] = data[offset:offset + count * dtype.itemsize].view(dtype).reshape(entry['shape'])
+
+    values = []
+    for name, weight in _flat_weights(model):
+        if name not in tensors:
+            raise ValueError('Weight %s is not in %s' % (name, path))
+        value = tensors[name]
+        if tuple(weight.shape) != value.shape:
+            raise ValueError('Weight %s has shape %s, %s holds %s' % (name, tuple(weight.shape), path, value.shape))
+        if value.dtype != weight.dtype.as_numpy_dtype:
+            value = value.astype(weight.dtype.as_numpy_dtype)
+        values.append((weight, value))
+    _assign(values)
+
+    print('loaded %s: %.1f MB in %.2fs' % (path, data.nbytes / 2 ** 20, time.time() - start))
+    return model
+
+
+def recompute_model(model, every=1):
+    """Same training model as `model` from `create_model(args)`, with gradient checkpointing every `every` blocks.
+
+    The encoder blocks are cut into segments of `every` blocks, and only the inputs of every segment are kept for the
+    backward pass, the activations inside are computed again from them. `every=1` keeps the least and recomputes the
+    most. The layers and weights are shared with `model`, which is the one to load and save.
+    """
+    n_layer = len([layer for layer in model.layers if layer.name.endswith('-FeedForward-Add')])
+    embed_token = model.get_layer(name='Embed-Token')
+    last_layer = model.get_layer(name='Embed-Token-Pos').output
+    bias_layer = model.get_layer(name='Attention-Bias').output
+
+    # The same graph, cut at the inputs and outputs of the segments
+    front = keras.models.Model(
+        inputs=model.inputs, outputs=[last_layer, bias_layer] + embed_token.output[1:], name='Recompute-Inputs')
+    segments = []
+    for start in range(0, n_layer, every):
+        output = model.get_layer(name='Encode-%d-FeedForward-Add' % (min(start + every, n_layer) - 1)).output
+        segments.append(keras.models.Model(inputs=[last_layer, bias_layer], outputs=output, name='Encode-%d-%d' % (
+            start, min(start + every, n_layer) - 1)))
+        last_layer = output
+    back = keras.models.Model(inputs=[last_layer] + embed_token.output[1:], outputs=model.output, name='Recompute-Outputs')
+
+    inputs = [keras.layers.Input(batch_shape=tensor.shape, dtype=tensor.dtype) for tensor in model.inputs]
+    last_layer, bias_layer, *embeddings = front(inputs)
+    for i, segment in enumerate(segments):
+        last_layer = Recompute(segment, name='Recompute-%d' % i)([last_layer, bias_layer])
+    return keras.models.Model(inputs=inputs, outputs=back([last_layer] + embeddings))
+
+
+class GradientAccumulation(keras.models.Model):
+    """Trains a model on batches of `accum_steps` micro-batches, one after the other.
+
+    Every batch given to `fit` is split into `accum_steps` micro-batches along the first axis, and the mean of their
+    gradients is applied in one optimizer update. Only one micro-batch is in memory at a time, plus one accumulator per
+    weight. The weights are the ones of the wrapped model, which is the one to load and save.
+    """
+
+    def __init__(self, model, accum_steps, **kwargs):
+        """Initialize the model.
+
+        :param model: Training model from `create_model(args)` or `recompute_model`.
+        :param accum_steps: Number of micro-batches in every batch.
+        :param kwargs: Arguments for parent class.
+        """
+        super(GradientAccumulation, self).__init__(**kwargs)
+        self.model = model
+        self.accum_steps = accum_steps
+
+    def call(self, inputs, training=None):
+        return self.model(inputs, training=training)
+
+    def train_step(self, data):
+        x, y, sample_weight = keras.utils.unpack_x_y_sample_weight(data)
+
+        def micro_batches(t):
+            if t is None:
+                return None
+            return tf.reshape(t, tf.concat([[self.accum_steps, -1], tf.shape(t)[1:]], axis=0))
+
+        x, y, sample_weight = micro_batches(x), micro_batches(y), micro_batches(sample_weight)
+        variables = self.trainable_variables
+
+        def step(i, gradients):
+            with tf.GradientTape() as tape:
+                y_pred = self(x[i], training=True)
+                loss = self.compute_loss(x[i], y[i], y_pred, None if sample_weight is None else sample_weight[i])
+                if isinstance(self.optimizer, keras.mixed_precision.LossScaleOptimizer):
+                    loss = self.optimizer.get_scaled_loss(loss)
+            # Sparse gradients of the embeddings are summed densely
+            return i + 1, [g + tf.convert_to_tensor(d) for g, d in zip(gradients, tape.gradient(loss, variables))]
+
+        _, gradients = tf.while_loop(
+            lambda i, _: i < self.accum_steps,
+            step,
+            [tf.constant(0), [tf.zeros_like(v) for v in variables]],
+        )
+        if isinstance(self.optimizer, keras.mixed_precision.LossScaleOptimizer):
+            gradients = self.optimizer.get_unscaled_gradients(gradients)
+        self.optimizer.apply_gradients(zip([g / self.accum_steps for g in gradients], variables))
+        return self.get_metrics_result()
+
+
 def create_schedule(args):
     decay_epochs = [int(x) for x in args.decay_epochs.split(',')]
 
     def schedule(epoch):
-        learning_rate = args.base_lr * args.batch_size
+        # Scaled by the batch of every update, which is larger than the batch in memory with gradient accumulation
+        learning_rate = args.base_lr * args.batch_size * args.accum_steps
         for e in decay_epochs:
 
             if epoch >= e:
@@ -0,0 +1,53 @@
+import numpy as np
+from tensorflow.keras import backend as K
+
+from src.layers import QuantizedEmbeddingRet, QuantizedMultiHeadAttention, QuantizedFeedForward
+
+
+def quantize(weights, axis=0):
+    """Symmetric int8 quantization with one scale per channel.
+
+    :param weights: Float array.
+    :param axis: Axis reduced by every scale, e.g. 0 for a kernel with shape `(input_dim, output_dim)`.
+    :return: Int8 array with the shape of `weights`, and float32 scales with `axis` removed from the shape.
+    """
+    scale = np.max(np.abs(weights), axis=axis) / 127.0
+    scale = np.where(scale > 0.0, scale, 1.0).astype(np.float32)
+    quantized = np.clip(np.round(weights / np.expand_dims(scale, axis)), -127, 127).astype(np.int8)
+    return quantized, scale
+
+
+def quantize_model(model, quantized_model):
+    """Copy the weights of a model into the same model built with `create_model(args, quantized=True)`.
+
+    The kernels are quantized per output channel and the token embeddings per token, which is the output channel of
+    the tied logits projection. The other weights are copied as they are.
+    """
+    values = []
+    for layer in quantized_model.layers:
+        if not layer.weights:
+            continue
+        source = model.get_layer(name=layer.name)
+        if isinstance(layer, QuantizedEmbeddingRet):
+            quantized, scale = quantize(K.get_value(source.embeddings), axis=1)
+            values += [(layer.embeddings, quantized), (layer.scale, scale)]
+        elif isinstance(layer, (QuantizedMultiHeadAttention, QuantizedFeedForward)):
+            if isinstance(layer, QuantizedMultiHeadAttention):
+                kernels, biases = ['Wqkv', 'Wo'], ['bqkv', 'bo']
+            else:
+                kernels, biases = ['W1', 'W2'], ['b1', 'b2']
+            for name in kernels:
+                quantized, scale = quantize(K.get_value(getattr(source, name)), axis=0)
+                values += [(getattr(layer, name), quantized), (getattr(layer, '%s_scale' % name), scale)]
+            for name in biases:
+                if getattr(layer, name) is not None:
+                    values.append((getattr(layer, name), K.get_value(getattr(source, name))))
+        else:
+            values += list(zip(layer.weights, source.get_weights()))
+    K.batch_set_value(values)
+    return quantized_model
+
+
+def weight_bytes(model):
+    """Memory taken by the weights of a model."""
+    return sum(int(np.prod(weight.shape)) * weight.dtype.size for weight in model.weights)
@@ -0,0 +1,109 @@
+"""Speculative decoding with a smaller draft model sharing the tokenizer of the target model.
+
+Every round the draft model proposes `num_draft` tokens one by one, then the target model scores all of them in one
+forward pass. A drafted token `x` is accepted with probability `min(1, p(x) / q(x))`, where `p` and `q` are the sampling
+distributions of the target and the draft. The first rejected position is resampled from `max(0, p - q)`, and if every
+draft is accepted one more token is sampled from the target. The output follows the sampling distribution of the
+target model exactly, see https://arxiv.org/pdf/2211.17192.pdf
+"""
+
+import numpy as np
+
+from src import generate
+from src import utils
+
+
+class SpeculativeStats(object):
+    """Counters of a speculative decoding run."""
+
+    def __init__(self):
+        self.rounds = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.emitted = 0
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted / max(self.proposed, 1)
+
+    @property
+    def tokens_per_round(self):
+        return self.emitted / max(self.rounds, 1)
+
+    def __str__(self):
+        return '%d rounds, %d / %d drafted tokens accepted (%.1f%%), %.2f tokens per target pass' % (
+            self.rounds, self.accepted, self.proposed, 100.0 * self.acceptance_rate, self.tokens_per_round)
+
+
+def sample_tokens(model, draft_model, context, batch_size, num_draft=4, temperature=1.0, top_k=0, top_p=1.0, rng=None,
+                  stats=None):
+    """Same as `generate.sample_tokens`, with the tokens drafted by `draft_model` and verified by `model`.
+
+    All rows advance by the same number of tokens per round, the smallest number accepted among them. The rows that
+    accepted more keep their drafted token at that position, which is a valid sample of the target as well.
+
+    :param model: Target model built with `create_model(args, past=True)`.
+    :param draft_model: Draft model built with `create_model(args, past=True)`.
+    :param num_draft: Number of tokens drafted per round.
+    :param stats: Optional `SpeculativeStats` updated as the rounds go.
+    """
+    settings = dict(temperature=temperature, top_k=top_k, top_p=top_p)
+    rows = np.arange(batch_size)
+    tokens = np.tile(np.asarray(context)[None, :], (batch_size, 1))
+
+    # The last token of `tokens` is always still to be fed to both models
+    target_past, target_length = generate.empty_past(model, batch_size), 0
+    draft_past, draft_length = generate.empty_past(draft_model, batch_size), 0
+    if tokens.shape[1] > 1:
+        _, target_past = generate.step(model, tokens[:, :-1], np.zeros(batch_size), target_past, last=1)
+        _, draft_past = generate.step(draft_model, tokens[:, :-1], np.zeros(batch_size), draft_past, last=1)
+        target_length = draft_length = tokens.shape[1] - 1
+
+    while True:
+        length = tokens.shape[1]
+
+        # Draft
+        drafted, draft_probs = tokens, []
+        for _ in range(num_draft):
+            logits, draft_past = generate.step(
+                draft_model, drafted[:, draft_length:], np.full(batch_size, draft_length), draft_past, last=1)
+            draft_length = drafted.shape[1]
+            probs = utils.logits_to_probs(logits[:, -1], **settings)
+            drafted = np.concatenate([drafted, utils.sample_probs(probs, rng)[:, None]], axis=1)
+            draft_probs.append(probs)
+        drafts = drafted[:, length:]
+
+        # Verify, the last `num_draft + 1` positions predict the drafts and the token after them
+        logits, target_past = generate.step(
+            model, drafted[:, target_length:], np.full(batch_size, target_length), target_past, last=num_draft + 1)
+        target_probs = [utils.logits_to_probs(logits[:, j - num_draft - 1], **settings) for j in range(num_draft + 1)]
+
+        ratio = np.stack([target_probs[j][rows, drafts[:, j]] / draft_probs[j][rows, drafts[:, j]]
+                          for j in range(num_draft)], axis=1)
+        accept = (rng if rng is not None else np.random).random_sample(ratio.shape) < ratio
+        accepted = np.where(np.all(accept, axis=1), num_draft, np.argmin(accept, axis=1))
+        n = int(accepted.min())
+
+        if n == num_draft:
+            last = utils.sample_probs(target_probs[n], rng)
+        else:
+            residual = np.maximum(target_probs[n] - draft_probs[n], 0.0)
+            empty = np.sum(residual, axis=-1, keepdims=True) <= 0.0
+            residual = np.where(empty, target_probs[n], residual)
+            last = np.where(accepted > n, drafts[:, n], utils.sample_probs(residual, rng))
+
+        new_tokens = np.concatenate([drafts[:, :n], last[:, None]], axis=1)
+        if stats is not None:
+            stats.rounds += 1
+            stats.proposed += num_draft * batch_size
+            stats.accepted += int(accepted.sum())
+            stats.emitted += n + 1
+
+        # Roll both caches back to the accepted tokens
+        target_length, draft_length = length + n, min(draft_length, length + n)
+        target_past = [p[:, :, :target_length] for p in target_past]
+        draft_past = [p[:, :, :draft_length] for p in draft_past]
+        tokens = np.concatenate([tokens, new_tokens], axis=1)
+
+        for j in range(n + 1):
+            yield new_tokens[:, j]
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+class StopTokens(object):
+    """Stop conditions compiled to token ids, checked on the sampled ids without decoding any text.
+
+    A line break is a single byte that can not be part of a multi-byte character, so every token whose bytes contain
+    it is known in advance. Stop strings are matched through a trie of the token ids the encoder produces for them,
+    with and without a leading space, which covers the way the model writes them in running text.
+    """
+
+    def __init__(self, enc, batch_size, newline=False, skip_leading_newline=False, sequences=()):
+        """
+        :param enc: `encoder.Encoder` of the model.
+        :param batch_size: Number of rows checked together.
+        :param newline: Stop a row at the first token that contains a line break.
+        :param skip_leading_newline: Ignore a line break that is the very first character of the output.
+        :param sequences: Stop strings, a row stops once it ends with the tokens of one of them.
+        """
+        self.newline = newline
+        self.skip_leading_newline = skip_leading_newline
+        self.newline_ids = np.array([b'\n' in token for token in enc.token_bytes])
+        self.inner_newline_ids = np.array([b'\n' in token[1:] for token in enc.token_bytes])
+
+        # Each trie node maps a token id to the next node, a node holding None under the key 'end' completes a string
+        self.trie = {}
+        for sequence in sequences:
+            for text in {sequence, ' ' + sequence.lstrip(' ')}:
+                node = self.trie
+                for token in enc.encode(text):
+                    node = node.setdefault(token, {})
+                node['end'] = None
+
+        self.length = 0
+        self.nodes = [[] for _ in range(batch_size)]
+        self.stopped = np.zeros(batch_size, dtype=bool)
+
+    def update(self, tokens):
+        """Feed the newest token of every row.
+
+        :param tokens: Integer array with shape `(batch_size,)`.
+        :return: Boolean array with shape `(batch_size,)`, True for the rows that reached a stop condition so far.
+        """
+        tokens = np.asarray(tokens)
+        if self.newline:
+            if self.length == 0 and self.skip_leading_newline:
+                self.stopped |= self.inner_newline_ids[tokens]
+            else:
+                self.stopped |= self.newline_ids[tokens]
+        if self.trie:
+            for row, token in enumerate(tokens.tolist()):
+                nodes = [node[token] for node in self.nodes[row] + [self.trie] if token in node]
+                self.stopped[row] |= any('end' in node for node in nodes)
+                self.nodes[row] = nodes
+        self.length += 1
+        return self.stopped
+
+    def token_ids(self):
+        """Ids of the tokens that stop a row on their own, e.g. for `generate.build_generate`."""
+        return np.flatnonzero(self.newline_ids).tolist() if self.newline else []
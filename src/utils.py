@@ -1,49 +1,81 @@
 import numpy as np
 
-def find_top_p(inputs, p, temperature, min_k = 1):
-    epsilon = 1e-4
-    indices, probs = np.array(list(map(lambda x: x[1], inputs))), np.array(list(map(lambda x: x[0], inputs)))
+def _candidates(logits, temperature, top_k, top_p, min_k):
+    """Most likely tokens of every row in descending order, with their probabilities after the cut offs."""
+    logits = np.asarray(logits, dtype=np.float64)
+    batch_size, n_vocab = logits.shape
+    temperature = np.reshape(np.asarray(temperature, dtype=np.float64), (-1, 1))
+    top_k = np.reshape(np.asarray(top_k, dtype=np.int64), (-1, 1))
+    top_p = np.reshape(np.asarray(top_p, dtype=np.float64), (-1, 1))
+    top_k = np.where(top_k <= 0, n_vocab, np.minimum(top_k, n_vocab))
+
+    # Only the candidates that can survive the cut off get sorted
+    k = int(top_k.max())
+    if k < n_vocab:
+        indices = np.argpartition(-logits, k - 1, axis=-1)[:, :k]
+    else:
+        indices = np.tile(np.arange(n_vocab), (batch_size, 1))
+    logits = np.take_along_axis(logits, indices, axis=-1)
+    order = np.argsort(-logits, axis=-1, kind='stable')
+    indices = np.take_along_axis(indices, order, axis=-1)
+    logits = np.take_along_axis(logits, order, axis=-1)
 
     # Softmax
-    probs = probs / temperature
-    probs = probs - np.max(probs)
-    probs = np.exp(probs)
-    probs = probs / np.sum(probs)
+    logits = logits / temperature
+    probs = np.exp(logits - logits[:, :1])
+    probs = np.where(np.arange(k)[None, :] < top_k, probs, 0.0)
+    probs /= np.sum(probs, axis=-1, keepdims=True)
 
-    # Cut off by accumulated probabilities
-    x = np.cumsum(probs)
-    m = np.where(x < p)
+    # Cut off by accumulated probabilities, keeping the token that crosses top_p
+    if np.any(top_p < 1.0):
+        keep = np.cumsum(probs, axis=-1) - probs < top_p
+        keep[:, :min_k] = True
+        probs = np.where(keep, probs, 0.0)
+        probs /= np.sum(probs, axis=-1, keepdims=True)
 
-    if m[0].size == 0:
-        m = (np.array(range(min_k)),)
+    return indices, probs
 
-    indices = indices[m[0]]
-    probs = probs[m[0]]
 
-    # Sample
-    # https://github.com/numpy/numpy/issues/8317
-    probs /= (1.0 + epsilon) * probs.sum()
-    s = np.random.multinomial(1, probs)
-    
-    return indices[np.where(s == 1)][0]
+def _uniform(rng, batch_size):
+    if rng is None:
+        rng = np.random
+    if isinstance(rng, (list, tuple)):
+        return np.array([r.random_sample() for r in rng])
+    return rng.random_sample(batch_size)
 
 
-def find_top_k(inputs, k, temperature):
-    epsilon = 1e-4
-    indices, probs = np.array(list(map(lambda x: x[1], inputs))), np.array(list(map(lambda x: x[0], inputs)))
+def sample_logits(logits, temperature=1.0, top_k=0, top_p=1.0, rng=None, min_k=1):
+    """Sample one token from every row of a batch of logits.
 
-    # Softmax
-    probs = probs / temperature
-    probs = probs - np.max(probs)
-    probs = np.exp(probs)
-    probs = probs / np.sum(probs)
-
-    indices = indices[:k]
-    probs = probs[:k]
-
-    # Sample
-    # https://github.com/numpy/numpy/issues/8317
-    probs /= (1.0 + epsilon) * probs.sum()
-    s = np.random.multinomial(1, probs)
-    
-    return indices[np.where(s == 1)][0]
\ No newline at end of file
+    :param logits: Array with shape `(batch_size, n_vocab)`.
+    :param temperature: Softmax temperature, a scalar or one value per row.
+    :param top_k: Only sample from the `top_k` most likely tokens, a scalar or one value per row. 0 disables the cut off.
+    :param top_p: Nucleus sampling, only sample from the smallest set of tokens whose probabilities add up to `top_p`.
+                  A scalar or one value per row, 1.0 disables the cut off.
+    :param rng: `np.random.RandomState` shared by all rows, or a list with one for each row. Defaults to `np.random`.
+    :param min_k: Minimum number of tokens kept by nucleus sampling.
+    :return: Integer array with shape `(batch_size,)`.
+    """
+    indices, probs = _candidates(logits, temperature, top_k, top_p, min_k)
+    batch_size = probs.shape[0]
+
+    # Sample by inverting the cumulative distribution
+    choice = np.sum(np.cumsum(probs, axis=-1) < _uniform(rng, batch_size)[:, None], axis=-1)
+    choice = np.minimum(choice, np.sum(probs > 0.0, axis=-1) - 1)
+
+    return indices[np.arange(batch_size), choice]
+
+
+def logits_to_probs(logits, temperature=1.0, top_k=0, top_p=1.0, min_k=1):
+    """The distribution over the whole vocabulary that `sample_logits` draws from, with shape `(batch_size, n_vocab)`."""
+    indices, probs = _candidates(logits, temperature, top_k, top_p, min_k)
+    dense = np.zeros(np.shape(logits), dtype=np.float64)
+    np.put_along_axis(dense, indices, probs, axis=-1)
+    return dense
+
+
+def sample_probs(probs, rng=None):
+    """Sample one token from every row of a batch of distributions with shape `(batch_size, n_vocab)`."""
+    batch_size = probs.shape[0]
+    choice = np.sum(np.cumsum(probs, axis=-1) < _uniform(rng, batch_size)[:, None] * np.sum(probs, axis=-1, keepdims=True), axis=-1)
+    return np.minimum(choice, probs.shape[1] - 1 - np.argmax(probs[:, ::-1] > 0.0, axis=-1))
@@ -1,12 +1,13 @@
-import numpy as np
+from concurrent.futures import Future
 
 import tensorflow as tf
-from tensorflow import keras
 
-from src.layers import EmbeddingSim, EmbeddingRet, PositionEmbedding, LayerNormalization, _get_encoder_component, gelu, ScaledDotProductAttention, MultiHeadAttention, FeedForward
 from src import encoder
 from src import net
-from src import utils
+from src import generate
+from src import engine
+from src import cache
+from src import stopping
 
 from memory import mem_compile
 
@@ -16,8 +17,6 @@ def init_model(args):
         if args.gpu_index:
                 physdevs = tf.config.list_physical_devices('GPU')
                 tf.config.experimental.set_virtual_device_configuration(physdevs[args.gpu_index], [tf.config.LogicalDeviceConfiguration(args.gpu_max_mem)])
-        
-        tf.compat.v1.disable_eager_execution()
 
         if not args.model_dir:
                 print('model path must be provided!')
@@ -35,78 +34,113 @@ def init_model(args):
         args.enc = encoder.get_encoder(args.json_encoder, args.vocab_bpe)
 
         if args.model_path.split('.')[-1] == 'h5':
-                args.model = keras.models.load_model(
-                args.model_path,
-                custom_objects={'EmbeddingSim': EmbeddingSim,
-                                'EmbeddingRet': EmbeddingRet,
-                                'PositionEmbedding': PositionEmbedding,
-                                'LayerNormalization': LayerNormalization,
-                                'ScaledDotProductAttention': ScaledDotProductAttention,
-                                'MultiHeadAttention': MultiHeadAttention,
-                                'FeedForward': FeedForward,
-                                'gelu': gelu,
-                                'loss': net.loss})
+                args.model = net.create_model(args, past=True, precision=args.precision, quantized=args.quantized)
+                args.model = net.load_h5_weights(args.model, args.model_path)
+        elif args.model_path.split('.')[-1] == 'gptw':
+                args.model = net.create_model(args, past=True, precision=args.precision, quantized=args.quantized)
+                args.model = net.load_flat_weights(args.model, args.model_path)
         elif args.model_path.split('.')[-1] == 'ckpt':
                 args.model_ckpt = args.model_path
-                args.model = net.create_model(args)
+                args.model = net.create_model(args, past=True, precision=args.precision)
                 args.model = net.load_weights(args.model, args)
-                args.model.compile(optimizer=keras.optimizers.Adam(), loss=net.loss)
         else:
                 print('Unsupported custom model format!')
                 exit()
         
         args.model.trainable = False
 
-def run_model(args, input_str):
+        # The persona context heads every prompt, keep its keys and values around between requests
+        args.prefix_cache = None
+        if args.prefix_cache_mb > 0:
+                args.prefix_cache = cache.PrefixCache(args.prefix_cache_mb * 2 ** 20)
+
+        # Optionally pad every step to a few fixed shapes, then trace the step once now instead of on the first message
+        if args.bucket_step > 0:
+                generate.use_buckets(args.model, key_step=args.bucket_step)
+        generate.warm_up(args.model)
+
+        args.engine = engine.Engine(args.model, max_batch_size=args.max_batch_size, prefix_cache=args.prefix_cache).start()
+
+def compile_input(args, input_str, input_stack):
         # Push the input_str into a list, and popping off the last members if it is past args.past_length
 
-        args.input_stack.append(input_str)
+        input_stack.append(input_str)
 
         # if past_length is 0, remember indefinitely.
         if args.past_length != 0:
-                if len(args.input_stack) > args.past_length:
-                        args.input_stack.pop()
+                if len(input_stack) > args.past_length:
+                        input_stack.pop()
 
         input_str = args.context + '\n' + mem_compile(input_str) + '\n'
-        for i in args.input_stack:
+        for i in input_stack:
                 input_str = input_str + i
-        
-        # TODO: Cleanup code since batch_size is not necessary.
-
-        input_str = input_str.replace("\\'", "'")
-
-        input_data = [args.enc.encode(input_str)] * args.batch_size
-        start_length = [len(data) for data in input_data]
-        flag_stop = [False] * args.batch_size
-        stop = False
-
-        # Inference the model..
-        for shift in range(args.output_length):
-                output_data = args.model.predict(np.array(input_data))
-                for index in range(args.batch_size):
-                        if not flag_stop[index]:
-                                probs = [(prob, i) for i, prob in enumerate(output_data[index, start_length[index] + shift - 1])]
-                                probs.sort(reverse=True)
-                                if args.nucleus:
-                                        next_token = utils.find_top_p(probs, args.top_p, args.temperature)
-                                else:
-                                        next_token = utils.find_top_p(probs, args.top_k, args.temperature)        
-                                
-                                input_data[index].append(next_token)
-                                if next_token == 50256:
-                                        flag_stop[index] = True
-                        else:
-                                input_data[index].append(50256)
-                        
-                        output = args.enc.decode(input_data[index])
-                        output = output[len(input_str):]
-
-                        for i, stopchar in enumerate(output):
-                                if ('\n' == stopchar) and (i > 0):
-                                        stop = True
-
-                if stop:
-                        args.input_stack.append(output)
-                        break
-
-        return output
+
+        return input_str.replace("\\'", "'")
+
+def compile_tokens(args, input_str, input_stack):
+        # Same as compile_input, but encoded and split into the persona context, which is pinned at the start of the
+        # window, and the rest, whose oldest tokens are dropped first once the conversation outgrows the model.
+
+        input_str = compile_input(args, input_str, input_stack)
+        persona = (args.context + '\n').replace("\\'", "'")
+
+        return args.enc.encode(persona), args.enc.encode(input_str[len(persona):])
+
+def is_stopped(output):
+        # The reply ends with the first line break that is not the very first character
+        return '\n' in output[1:]
+
+def stop_checker(enc):
+        # Same as is_stopped, but fed one token id at a time instead of the whole output.
+        stop_tokens = stopping.StopTokens(enc, 1, newline=True, skip_leading_newline=True)
+
+        def stop(tokens):
+                return bool(stop_tokens.update(tokens[-1:])[0])
+
+        return stop
+
+def submit_model(args, input_str, input_stack=None, on_text=None):
+        # Queue the request on args.engine, where it is decoded together with the other requests in flight.
+        # Returns a Future resolved with the generated string.
+        # on_text is called from the engine thread with every newly decoded piece of the output.
+
+        if input_stack is None:
+                input_stack = args.input_stack
+
+        pinned, rest = compile_tokens(args, input_str, input_stack)
+        # Once the conversation fills the context of the model, the engine drops its oldest tokens after the persona
+        tokens = generate.fit_window(pinned, rest, args.engine.n_ctx - args.engine.evict)
+        future = Future()
+
+        on_token = None
+        if on_text is not None:
+                stream = args.enc.stream_decoder()
+
+                def on_token(token):
+                        text = stream.decode([token])
+                        if text:
+                                on_text(text)
+
+        def done(tokens_future):
+                try:
+                        output = args.enc.decode(tokens_future.result())
+                except Exception as e:
+                        future.set_exception(e)
+                        return
+                if is_stopped(output):
+                        input_stack.append(output)
+                future.set_result(output)
+
+        args.engine.submit(
+                tokens,
+                args.output_length,
+                temperature=args.temperature,
+                top_k=0 if args.nucleus else args.top_k,
+                top_p=args.top_p if args.nucleus else 1.0,
+                seed=args.seed,
+                stop=stop_checker(args.enc),
+                on_token=on_token,
+                pinned=len(pinned),
+        ).add_done_callback(done)
+
+        return future
@@ -0,0 +1,33 @@
+import json
+import types
+
+import numpy as np
+import tensorflow as tf
+
+from src import net
+from src import generate
+
+
+def small_model(tmp_path, past):
+    hparams = tmp_path / 'hparams.json'
+    hparams.write_text(json.dumps(dict(n_vocab=50, n_ctx=32, n_embd=16, n_head=2, n_layer=2)))
+    return net.create_model(types.SimpleNamespace(json_hparams=str(hparams), batch_size=None), past=past)
+
+
+def test_step_keeps_the_cache_on_the_device(tmp_path):
+    full, model = small_model(tmp_path, past=False), small_model(tmp_path, past=True)
+    model.set_weights(full.get_weights())
+    tokens = np.array([[1, 2, 3, 4, 5, 6], [7, 8, 9, 10, 11, 12]])
+    expected = full.predict_on_batch(tokens)
+
+    # With and without the padding of the buckets
+    for key_step in [None, 8]:
+        if key_step is not None:
+            generate.use_buckets(model, key_step=key_step)
+        logits, past = generate.step(model, tokens[:, :4], np.zeros(2), generate.empty_past(model, 2))
+        assert all(isinstance(p, tf.Tensor) and p.shape[2] == 4 for p in past)
+        for position in [4, 5]:
+            next_logits, past = generate.step(model, tokens[:, position:position + 1], np.full(2, position), past)
+            logits = np.concatenate([logits, next_logits], axis=1)
+        assert all(isinstance(p, tf.Tensor) and p.shape[2] == 6 for p in past)
+        np.testing.assert_allclose(logits, expected, atol=1e-4)
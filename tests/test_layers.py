@@ -0,0 +1,26 @@
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from src.layers import ScaledDotProductAttention, MultiHeadAttention
+
+
+def test_attention_defaults_in_functional_model():
+    inputs = keras.layers.Input((5, 4))
+    model = keras.Model(inputs, [ScaledDotProductAttention()([inputs, inputs, inputs]),
+                                 MultiHeadAttention(head_num=2)(inputs)])
+    for output in model(np.ones((2, 5, 4), dtype=np.float32)):
+        assert output.shape == (2, 5, 4)
+
+
+def test_attention_defaults_in_tf_function():
+    attention, multi_head = ScaledDotProductAttention(), MultiHeadAttention(head_num=2)
+
+    @tf.function
+    def call(x):
+        return attention([x, x, x]), multi_head(x)
+
+    # Twice, a second trace must not create new variables either
+    for length in [5, 7]:
+        for output in call(tf.ones((2, length, 4))):
+            assert output.shape == (2, length, 4)
@@ -0,0 +1,31 @@
+import json
+import types
+
+import numpy as np
+import tensorflow as tf
+
+from src import net
+
+
+def test_h5_and_checkpoint_freeze_the_same_layers(tmp_path):
+    hparams = tmp_path / 'hparams.json'
+    hparams.write_text(json.dumps(dict(n_vocab=50, n_ctx=32, n_embd=16, n_head=2, n_layer=2)))
+    args = types.SimpleNamespace(json_hparams=str(hparams), batch_size=None, model_ckpt=str(tmp_path / 'model.ckpt'))
+
+    # A checkpoint under the names of the released models, the kernels without their leading 1x1 dimension
+    model = net.create_model(args)
+    names, tensors = [], []
+    for layer_name, variables in net._checkpoint_names(2):
+        names += variables
+        tensors += [tf.constant(weight.numpy()) for weight in model.get_layer(name=layer_name).weights]
+    tf.raw_ops.SaveV2(prefix=args.model_ckpt, tensor_names=names, shape_and_slices=[''] * len(names), tensors=tensors)
+
+    from_checkpoint = net.load_weights(net.create_model(args), args)
+    from_checkpoint.save(str(tmp_path / 'model.h5'), include_optimizer=False)
+    from_h5 = net.load_h5_weights(net.create_model(args), str(tmp_path / 'model.h5'))
+
+    assert len(from_h5.trainable_weights) == len(from_checkpoint.trainable_weights) == 24
+    for layer_name in ['Embed-Token', 'Embed-Token-Pos', 'Norm']:
+        assert not from_h5.get_layer(name=layer_name).trainable
+    for expected, loaded in zip(from_checkpoint.get_weights(), from_h5.get_weights()):
+        np.testing.assert_array_equal(expected, loaded)
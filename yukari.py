@@ -1,4 +1,5 @@
 import argparse
+import asyncio
 import time
 from discord import Status
 from discord import Game
@@ -28,6 +29,13 @@ parser.add_argument('--past_length', type=int, help='amount of memorized inputs
 parser.add_argument('--mem_path', type=str, help='path to memories json file', default='yukarimemory.json')
 parser.add_argument('--gpu_index', type=int, help='which GPU to inference the AI on', default=None)
 parser.add_argument('--gpu_max_mem', type=int, help='sets max GPU VRAM usage in megabytes', default=4096)
+parser.add_argument('--max_batch_size', type=int, help='maximum number of requests generated together', default=8)
+parser.add_argument('--prefix_cache_mb', type=int, help='memory budget in megabytes for reusing the computed context between requests, 0 disables it', default=512)
+parser.add_argument('--edit_interval', type=float, help='seconds between edits of the reply while it is being generated', default=1.0)
+parser.add_argument('--seed', type=int, help='random seed for sampling, every request is seeded with it if set', default=None)
+parser.add_argument('--bucket_step', type=int, help='cached lengths are padded to multiples of this, only worth it where kernels are tuned for every shape. 0 disables it', default=0)
+parser.add_argument('--precision', type=str, help='dtype of the weights and matrix products, the normalization, softmax and logits stay in float32', default='float32', choices=['float32', 'float16', 'bfloat16'])
+parser.add_argument('--quantized', help='the custom .h5 or .gptw model holds int8 weights written by quantize.py', action='store_true')
 
 args = parser.parse_args()
 
@@ -41,17 +49,58 @@ def log(com, logstr):
         timestamp = time.time() - start_time
         print('[' + trunc(timestamp, 4) + '] ' + com + ': ' + logstr)
 
-def actjob(message):
+# Every channel holds its own conversation, so requests from different channels can be generated together.
+# Within a channel they take turns, every prompt needs the reply to the previous one.
+stacks = {}
+locks = {}
+
+def channel_stack(context):
+        return stacks.setdefault(context.message.channel.id, [])
+
+def channel_lock(context):
+        return locks.setdefault(context.message.channel.id, asyncio.Lock())
+
+async def actjob(context, message, redo=False):
+        async with channel_lock(context):
+                if redo:
+                        channel_stack(context).pop()
+                return await generate_reply(context, message)
+
+async def generate_reply(context, message):
+        # Generation runs on the engine thread. The reply is sent right away and edited as the text comes in.
         if message != '':
                 log('ai  ', 'Processing Act job -- [' + message + ']')
                 message = message + '\n'
         else:
                 log('ai  ', 'Processing Redo job')
-        
-        output = run_model(args, message)
+
+        loop = asyncio.get_event_loop()
+        pieces = asyncio.Queue()
+        future = asyncio.wrap_future(submit_model(
+                args, message, channel_stack(context),
+                on_text=lambda text: loop.call_soon_threadsafe(pieces.put_nowait, text)))
+
+        reply = await context.message.channel.send('...')
+        streamed = ''
+        while not future.done():
+                await asyncio.wait([future], timeout=args.edit_interval)
+                edited = streamed
+                while not pieces.empty():
+                        edited = edited + pieces.get_nowait()
+                if edited.strip() != streamed.strip() and not future.done():
+                        await reply.edit(content=edited)
+                streamed = edited
+
+        output = future.result()
+        if output.strip():
+                await reply.edit(content=output)
         logged_output = output.replace('\n', '')
 
         log('ai  ', 'Generated result -- [' + logged_output + ']')
+        if args.prefix_cache is not None:
+                stats = args.prefix_cache.stats()
+                log('ai  ', 'Prefix cache -- %d hits, %d misses, %d reused / %d computed tokens'
+                    % (stats['hits'], stats['misses'], stats['reused_tokens'], stats['computed_tokens']))
 
         return output
 
@@ -68,7 +117,8 @@ async def on_ready():
                 pass_context=True)
 async def resetcmd(context):
         log('ai  ', 'Restarting AI inferencer...')
-        args.input_stack = []
+        async with channel_lock(context):
+                channel_stack(context).clear()
         log('ai  ', 'Done!~')
         await context.message.channel.send("Done!~")
 
@@ -132,7 +182,7 @@ async def outlengthcmd(context):
 async def rawcmd(context):
         message = context.message.content[6:]
         
-        await context.message.channel.send(actjob(message))
+        await actjob(context, message)
 
 @client.command(name='say',
                 description='Say something to Yukari!',
@@ -142,7 +192,7 @@ async def rawcmd(context):
 async def saycmd(context):
         message = "You say, \"" + context.message.content[6:] + "\""
 
-        await context.message.channel.send(actjob(message))
+        await actjob(context, message)
 
 @client.command(name='do',
                 decsription='Do something to Yukari!',
@@ -155,16 +205,14 @@ async def docmd(context):
         if message[-1:] != '.':
                 message = message + '.'
 
-        await context.message.channel.send(actjob(message))
+        await actjob(context, message)
 
 @client.command(name='redo',
                 description='Redo an action',
                 brief='Redo an action',
                 pass_context=True)
 async def redocmd(context):
-        args.input_stack.pop()
-        
-        await context.message.channel.send(actjob(''))
+        await actjob(context, '', redo=True)
 
 @client.command(name='forget',
                 description='Make Yukari forget something!',